@@ -0,0 +1,100 @@
+# Benchmark of the methods to fill the masked area before smoothing
+#
+# Compares the fast methods of `taper_masked_area` to the iterative filler
+# on runtime, and on how much the smoothed field differs from the iterative
+# result over the valid area, as a function of distance to the coast.
+#
+# Usage:
+#   python benchmark_taper.py                 # synthetic field
+#   python benchmark_taper.py --data-folder <path> --model <model> \
+#       --scenario <scenario> --variable <variable>
+
+import argparse
+import datetime
+import time
+
+import numpy as np
+from scipy import ndimage
+
+from hypercc import Box, DataSet, MaskedData, gaussian_filter, \
+    taper_masked_area
+from hypercc.filters import TAPER_METHODS
+from hypercc.units import unit
+
+
+def synthetic_data(n_t, n_lat, n_lon, seed=0):
+    """Smooth random field on a global grid, with a mask of random round
+    continents."""
+    random = np.random.RandomState(seed)
+    lat = np.linspace(-90, 90, n_lat + 1)
+    lon = np.linspace(0, 360, n_lon + 1)
+    lat_c, lon_c = (lat[1:] + lat[:-1]) / 2, (lon[1:] + lon[:-1]) / 2
+    box = Box(np.arange(n_t) * 365.0, lat_c, lon_c,
+              np.c_[lat[:-1], lat[1:]], np.c_[lon[:-1], lon[1:]],
+              'days', datetime.date(1850, 1, 1), '365_day')
+
+    data = ndimage.gaussian_filter(
+        random.normal(size=(n_t, n_lat, n_lon)), [3, 2, 2], mode='wrap')
+    data += np.linspace(0, 1, n_t)[:, None, None]
+
+    mask = np.zeros((n_lat, n_lon), dtype=bool)
+    y, x = np.mgrid[:n_lat, :n_lon]
+    for _ in range(8):
+        cy, cx = random.randint(n_lat), random.randint(n_lon)
+        r = random.randint(n_lat // 12, n_lat // 5)
+        dx = np.minimum(abs(x - cx), n_lon - abs(x - cx))
+        mask |= (y - cy)**2 + dx**2 < r**2
+
+    return box, MaskedData(data.astype('float32'), mask)
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--data-folder")
+parser.add_argument("--model")
+parser.add_argument("--scenario", default='rcp85')
+parser.add_argument("--variable", default='tos')
+parser.add_argument("--realization", default='r1i1p1')
+parser.add_argument("--shape", nargs=3, type=int, default=[150, 180, 360])
+parser.add_argument("--sigma-x", type=float, default=200, help="km")
+parser.add_argument("--sigma-t", type=float, default=10, help="year")
+args = parser.parse_args()
+
+if args.data_folder:
+    data_set = DataSet.cmip5(
+        args.data_folder, args.model, args.variable, args.scenario,
+        args.realization).annual_mean()
+    box, data = data_set.box, data_set.data
+else:
+    box, data = synthetic_data(*args.shape)
+
+if not isinstance(data, MaskedData):
+    raise SystemExit("This data set has no mask, nothing to taper.")
+
+sigma = [args.sigma_t * unit.year,
+         args.sigma_x * unit.km, args.sigma_x * unit.km]
+mask = data.mask if data.mask.ndim == 2 else data.mask[0]
+# distance of each valid point to the nearest masked point, in pixels
+coast_distance = ndimage.distance_transform_edt(~mask)
+
+print("data shape {}, {:.1f}% masked".format(data.shape, 100 * mask.mean()))
+print("{:<12} {:>10} {:>12} {:>12} {:>12} {:>12}".format(
+    "method", "time (s)", "max diff", "rms diff", "diff d<=2", "diff d>5"))
+
+smooth = {}
+for method in TAPER_METHODS:
+    tapered = data.copy()
+    t0 = time.time()
+    taper_masked_area(tapered, [0, 5, 5], 50, method=method)
+    elapsed = time.time() - t0
+    smooth[method] = gaussian_filter(box, tapered, sigma).data
+
+    diff = np.abs(smooth[method] - smooth['iterative'])[:, ~mask]
+    near = (coast_distance <= 2)[~mask]
+    far = (coast_distance > 5)[~mask]
+    print("{:<12} {:>10.2f} {:>12.3g} {:>12.3g} {:>12.3g} {:>12.3g}".format(
+        method, elapsed, diff.max(), np.sqrt((diff**2).mean()),
+        diff[:, near].max() if near.any() else 0,
+        diff[:, far].max() if far.any() else 0))
+
+spread = np.abs(smooth['iterative'][:, ~mask]).std()
+print("(standard deviation of the smoothed field: {:.3g})".format(spread))
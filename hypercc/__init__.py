@@ -1,14 +1,23 @@
 from .data.box import Box
 from .data.data_set import DataSet
 from .data.file import File
+from .data.masked import MaskedData
+from .data.cache import ArrayCache, DiskCache
+from .data.catalogue import Catalogue
 
 from .calibration import calibrate_sobel
 from .filters import (
-    sobel_filter, gaussian_filter, taper_masked_area)
-from .stats import weighted_quartiles
+    sobel_filter, sobel_derivatives, scale_sobel, gaussian_filter,
+    taper_masked_area, tiled_sobel_filter)
+from .smoothing import SmoothingCache, smooth, smooth_pyramid
+from .stats import weighted_quartiles, column_argmax
+from .regions import find_regions
 
 __all__ = [
-    'Box', 'DataSet', 'File',
-    'calibrate_sobel', 'gaussian_filter', 'taper_masked_area',
-    'weighted_quartiles'
+    'Box', 'DataSet', 'File', 'MaskedData', 'ArrayCache', 'DiskCache',
+    'Catalogue',
+    'calibrate_sobel', 'sobel_filter', 'sobel_derivatives', 'scale_sobel',
+    'gaussian_filter', 'taper_masked_area',
+    'tiled_sobel_filter', 'SmoothingCache', 'smooth', 'smooth_pyramid',
+    'weighted_quartiles', 'column_argmax', 'find_regions'
 ]
@@ -5,21 +5,42 @@ Calibration of space-time fractions.
 import numpy as np
 from .stats import weighted_quartiles
 from .filters import sobel_filter
+from .data.masked import MaskedData
+from . import memory
 
 
-def calibrate_sobel(quartile, box, data, delta_t, delta_d):
+@memory.stage('calibration')
+def calibrate_sobel(quartile, box, data, delta_t, delta_d, interior=None,
+                    workers=None, sobel_data=None):
     """Calibrate the weights of the Sobel operator.
 
     :param box: Box instance
-    :param data: ndarray or masked array with shape equal to box.shape
+    :param data: ndarray or MaskedData with shape equal to box.shape
     :param delta_t: start value for delta_t
     :param delta_d: start value for delta_d
+    :param interior: optional tuple of slices; if given, the statistics are
+        computed only over this part of the data, after filtering.
+    :param workers: number of threads for the Sobel filter.
+    :param sobel_data: optional output of :py:func:`sobel_filter` on `data`
+        with weights ``[delta_t, delta_d, delta_d]``, if it was computed
+        beforehand; `data` is then only used for its shape and mask.
     :return: dictionary with statistical information about data
     """
-    sbc = sobel_filter(box, data, weight=[delta_t, delta_d, delta_d])
+    if sobel_data is not None:
+        sbc = sobel_data
+    else:
+        sbc = sobel_filter(
+            box, data, weight=[delta_t, delta_d, delta_d], workers=workers)
+
+    if interior is not None:
+        sbc = sbc[(slice(None),) + interior]
+        box = box[interior]
+        data = data[interior]
 
 
     gradients=sbc[0:2]
+    if isinstance(gradients, MaskedData):
+        gradients = gradients.compressed()
     nancount=np.isnan(gradients).sum()
     if nancount > 0:
         print(' ')
@@ -33,21 +54,22 @@ def calibrate_sobel(quartile, box, data, delta_t, delta_d):
     
     #sbc=np.longdouble(sbc)   # higher precision to avoid overflow
     
-    if isinstance(data, np.ma.core.MaskedArray) \
-            and (data.mask is not np.ma.nomask):
-        var_t = (sbc[0]**2 / sbc[3]**2).compressed()
-        var_x = ((sbc[1]**2 + sbc[2]**2) / sbc[3]**2).compressed()
-        var_m = (1.0 / sbc[3]).compressed()
-        weights = np.repeat(
-            box.relative_grid_area[None, :, :],
-            box.shape[0], axis=0)[~data.mask].flatten()
+    # weights in the precision of the data
+    area = box.relative_grid_area.astype(data.dtype)
+    if isinstance(data, MaskedData):
+        # np.power rounds like the masked array arithmetic used before
+        sbc_t, sbc_y, sbc_x, sbc_m = (
+            np.power(sbc[i].compressed(), 2) for i in range(4))
+        var_t = sbc_t / sbc_m
+        var_x = (sbc_y + sbc_x) / sbc_m
+        var_m = 1.0 / sbc[3].compressed()
+        weights = MaskedData(
+            np.broadcast_to(area, data.shape), data.mask).compressed()
     else:
         var_t = (sbc[0]**2 / sbc[3]**2).flatten()
         var_x = ((sbc[1]**2 + sbc[2]**2) / sbc[3]**2).flatten()
         var_m = (1.0 / sbc[3]).flatten()
-        weights = np.repeat(
-            box.relative_grid_area[None, :, :],
-            box.shape[0], axis=0).flatten()
+        weights = np.broadcast_to(area, data.shape).flatten()
 
 
     ###Ignore nans when calculating the distributions
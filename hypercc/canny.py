@@ -0,0 +1,148 @@
+"""
+Edge thinning and hysteresis thresholding with ``hyper_canny``, optionally
+split in tiles that are processed on a pool of threads.
+
+The arrays are in the layout expected by ``hyper_canny``: the Sobel output
+has shape ``(lon, lat, time, 4)`` and the masks ``(lon, lat, time)``. Tiles
+are taken along the first axis, so that each is a contiguous block.
+"""
+
+import numpy as np
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from hyper_canny import cp_edge_thinning, cp_double_threshold
+
+from .filters import map_tiles
+
+
+EDGE_CONNECTIVITY = ndimage.generate_binary_structure(3, 3)
+"""Neighbourhood along which hysteresis thresholding follows edges: all 26
+neighbours of a pixel. This is assumed to match ``cp_double_threshold``;
+tiled thresholding, see :py:func:`double_threshold`, relies on it."""
+
+
+def tile_bounds(n, n_tiles):
+    """Split ``range(n)`` into at most `n_tiles` contiguous tiles.
+
+    :return: list of slices.
+    """
+    bounds = np.linspace(0, n, min(n_tiles, n) + 1).astype(int)
+    return [slice(a, b) for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+def edge_thinning(sobel, n_tiles=None, workers=None):
+    """Non-maximum suppression by ``cp_edge_thinning``. The suppression
+    looks at direct neighbours only, so each tile is thinned with a halo of
+    one pixel, which is cut off afterwards; the result equals that of a
+    single call.
+
+    :param sobel: C-contiguous Sobel output of shape ``(lon, lat, time, 4)``.
+    :param n_tiles: number of tiles; if None or 1, the volume is thinned in
+        a single call.
+    :param workers: number of threads.
+    :return: boolean mask of shape ``(lon, lat, time)``.
+    """
+    n = sobel.shape[0]
+    if n_tiles is None or n_tiles <= 1 or n <= 1:
+        return cp_edge_thinning(sobel)
+
+    mask = np.empty(sobel.shape[:-1], dtype=bool)
+
+    def thin(t):
+        lo, hi = max(0, t.start - 1), min(n, t.stop + 1)
+        mask[t] = cp_edge_thinning(sobel[lo:hi])[t.start - lo:t.stop - lo]
+
+    map_tiles(thin, tile_bounds(n, n_tiles), workers)
+    return mask
+
+
+def boundary_pairs(a, b, structure):
+    """Pairs of labels of adjacent planes `a` and `b` that touch according
+    to the last plane of `structure`.
+
+    :return: tuple of arrays (labels in `a`, labels in `b`).
+    """
+    n_i, n_j = a.shape
+    pairs_a, pairs_b = [], []
+    for di, dj in zip(*np.nonzero(structure[2])):
+        di, dj = di - 1, dj - 1
+        sa = a[max(0, -di):n_i - max(0, di), max(0, -dj):n_j - max(0, dj)]
+        sb = b[max(0, di):n_i - max(0, -di), max(0, dj):n_j - max(0, -dj)]
+        touch = (sa != 0) & (sb != 0)
+        pairs_a.append(sa[touch])
+        pairs_b.append(sb[touch])
+    return np.concatenate(pairs_a), np.concatenate(pairs_b)
+
+
+def double_threshold(sobel, mask, upper, lower, n_tiles=None, workers=None,
+                     structure=EDGE_CONNECTIVITY):
+    """Hysteresis thresholding by ``cp_double_threshold``: keep the pixels
+    of `mask` above the lower threshold that are connected to a pixel above
+    the upper threshold.
+
+    In tiles, the pixels above each threshold are selected by
+    ``cp_double_threshold`` with equal thresholds, and those above the
+    lower threshold are labelled by connected component. Components that
+    touch across the boundary of two tiles are merged, and the ones holding
+    a pixel above the upper threshold are kept. This equals a single call
+    only if `structure` is the connectivity that ``cp_double_threshold``
+    follows, assumed to be all 26 neighbours (:py:data:`EDGE_CONNECTIVITY`);
+    ``tests/test_canny.py`` compares the tiled result with a single call.
+
+    :param sobel: C-contiguous Sobel output of shape ``(lon, lat, time, 4)``.
+    :param mask: C-contiguous boolean mask of shape ``(lon, lat, time)``.
+    :param upper: upper threshold, on the inverse magnitude as for
+        ``cp_double_threshold``.
+    :param lower: lower threshold, idem.
+    :param n_tiles: number of tiles; if None or 1, a single call is made.
+    :param workers: number of threads.
+    :param structure: connectivity of the edges in the tiled computation.
+    :return: boolean mask of shape ``(lon, lat, time)``.
+    """
+    n = sobel.shape[0]
+    if n_tiles is None or n_tiles <= 1 or n <= 1:
+        return cp_double_threshold(sobel, mask, upper, lower)
+
+    tiles = tile_bounds(n, n_tiles)
+    labels = np.empty(mask.shape, dtype=np.int32)
+
+    def label(t):
+        weak = np.asarray(
+            cp_double_threshold(sobel[t], mask[t], lower, lower), dtype=bool)
+        strong = np.asarray(
+            cp_double_threshold(sobel[t], mask[t], upper, upper), dtype=bool)
+        n_labels = ndimage.label(weak, structure, output=labels[t])
+        return n_labels, np.unique(labels[t][strong])
+
+    counts, seeds = zip(*map_tiles(label, tiles, workers))
+    offsets = np.cumsum((0,) + counts[:-1])
+    n_total = offsets[-1] + counts[-1] + 1
+
+    # merge components across tile boundaries; global label 0 is background
+    pairs = [boundary_pairs(labels[t.start - 1], labels[t.start], structure)
+             for t in tiles[1:]]
+    rows = np.concatenate(
+        [[0]] + [p[0] + o for p, o in zip(pairs, offsets[:-1])])
+    cols = np.concatenate(
+        [[0]] + [p[1] + o for p, o in zip(pairs, offsets[1:])])
+    graph = coo_matrix((np.ones(len(rows), dtype=bool), (rows, cols)),
+                       shape=(n_total, n_total))
+    _, component = connected_components(graph, directed=False)
+
+    strong = np.zeros(component.max() + 1, dtype=bool)
+    for s, o in zip(seeds, offsets):
+        strong[component[s[s != 0] + o]] = True
+    keep = strong[component]
+
+    result = np.empty(mask.shape, dtype=bool)
+
+    def select(t, o, c):
+        lookup = keep[o:o + c + 1].copy()
+        lookup[0] = False
+        result[t] = lookup[labels[t]]
+
+    map_tiles(lambda i: select(tiles[i], offsets[i], counts[i]),
+              range(len(tiles)), workers)
+    return result
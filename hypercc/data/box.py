@@ -3,12 +3,13 @@ Box stores knowledge about
 """
 
 from copy import copy
-from datetime import timedelta, date
+from datetime import date
 
 import numpy as np
 
 from ..units import R_EARTH, DAY
 from .file import parse_time_units
+from .calendars import decode_time, to_dates
 
 
 def is_linear(a, eps=1e-3):
@@ -22,7 +23,8 @@ class Box:
     def __init__(self, time, lat, lon,
                  lat_bnds=None, lon_bnds=None,
                  time_units='days',
-                 time_start=date(1850, 1, 1)):
+                 time_start=date(1850, 1, 1),
+                 calendar='standard'):
         self.time = time
         self.lat = lat
         self.lon = lon
@@ -31,6 +33,10 @@ class Box:
 
         self.time_units = time_units
         self.time_start = time_start
+        self.calendar = calendar
+
+        self._ymd = None
+        self._dates = None
 
     def __serialize__(self, pack):
         return pack({
@@ -40,7 +46,8 @@ class Box:
             'lat_bnds': self.lat_bnds,
             'lon_bnds': self.lon_bnds,
             'time_units': self.time_units,
-            'time_start': self.time_start
+            'time_start': self.time_start,
+            'calendar': self.calendar
         })
 
     @classmethod
@@ -74,6 +81,7 @@ class Box:
             box.generate_bounds()
 
         box.time_units, box.time_start = parse_time_units(nc.variables['time'].units)
+        box.calendar = getattr(nc.variables['time'], 'calendar', 'standard')
         return box
 
     @staticmethod
@@ -113,29 +121,61 @@ class Box:
         self.lon_bnds = lon_bnds
 
     def date(self, value):
-        """Convert a time value to a date."""
-        try:
-            return (self.date(t) for t in value)
-        except TypeError:
-            pass
+        """Convert a time value, or a sequence of time values, to dates."""
+        dates = to_dates(*decode_time(
+            np.atleast_1d(value), self.time_units, self.time_start,
+            self.calendar))
+        return dates if np.ndim(value) > 0 else dates[0]
+
+    @property
+    def ymd(self):
+        """Years, months and days of the time axis, as a tuple of integer
+        arrays. These are computed once and kept, also when slicing."""
+        if self._ymd is None:
+            self._ymd = decode_time(
+                self.time, self.time_units, self.time_start, self.calendar)
+        return self._ymd
 
-        kwargs = {self.time_units: value}
-        return self.time_start + timedelta(**kwargs)
+    @property
+    def years(self):
+        """Years of the time axis, as an integer array."""
+        return self.ymd[0]
 
     @property
     def dates(self):
         """Convert the time axis to dates."""
-        return list(self.date(self.time))
+        if self._dates is None:
+            self._dates = to_dates(*self.ymd)
+        return self._dates
 
     def __getitem__(self, s):
-        """Slices the box in the same way as you would slice data."""
+        """Slices the box in the same way as you would slice data. Bounds
+        are sliced along with the latitudes and longitudes. If the selected
+        longitudes wrap around, 360 degrees is added to the longitudes past
+        the wrapping point, so that they keep increasing."""
         new_box = copy(self)
 
         if not isinstance(s, tuple):
             s = (s,)
 
+        if isinstance(self.time, np.ndarray):
+            new_box._ymd = tuple(a[s[0]] for a in self.ymd)
+            new_box._dates = None
+
         for q, t in zip(s, ['time', 'lat', 'lon']):
-            setattr(new_box, t, getattr(self, t).__getitem__(s))
+            setattr(new_box, t, getattr(self, t).__getitem__(q))
+            bnds = getattr(self, t + '_bnds', None)
+            if bnds is not None:
+                setattr(new_box, t + '_bnds', bnds[q])
+
+        if len(s) > 2 and np.ndim(new_box.lon) == 1:
+            wraps = np.where(np.diff(new_box.lon) < 0)[0]
+            if len(wraps) > 0:
+                new_box.lon = new_box.lon.copy()
+                new_box.lon[wraps[0]+1:] += 360
+                if new_box.lon_bnds is not None:
+                    new_box.lon_bnds = new_box.lon_bnds.copy()
+                    new_box.lon_bnds[wraps[0]+1:] += 360
 
         return new_box
 
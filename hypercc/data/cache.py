@@ -0,0 +1,246 @@
+"""
+Caches for arrays loaded from NetCDF files.
+"""
+
+from collections import OrderedDict
+from pathlib import Path
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+
+from .masked import MaskedData
+
+
+def selection_key(selection):
+    """Convert a selection (as given to ``__getitem__``) into a hashable
+    value that can be used as part of a cache key."""
+    if isinstance(selection, slice):
+        return ('slice', selection.start, selection.stop, selection.step)
+    if isinstance(selection, tuple):
+        return tuple(selection_key(s) for s in selection)
+    if isinstance(selection, np.ndarray):
+        return ('array', selection.dtype.str, selection.shape,
+                selection.tobytes())
+    return selection
+
+
+def array_nbytes(a):
+    """Number of bytes held by an array, including the mask of a masked
+    array."""
+    nbytes = a.nbytes
+    mask = getattr(a, 'mask', np.ma.nomask)
+    if mask is not np.ma.nomask:
+        nbytes += mask.nbytes
+    return nbytes
+
+
+def set_read_only(a):
+    """Mark an array (and its mask) as read-only, so that arrays handed out
+    by the cache cannot be changed behind its back."""
+    a.setflags(write=False)
+    mask = getattr(a, 'mask', np.ma.nomask)
+    if mask is not np.ma.nomask:
+        mask.setflags(write=False)
+    return a
+
+
+class ArrayCache(object):
+    """Least-recently-used in-memory cache of arrays, limited by a budget in
+    bytes. Arrays are stored read-only; callers that need to modify the
+    data in place should make a copy first.
+
+    :param max_bytes: maximum number of bytes held by the cache.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    @property
+    def nbytes(self):
+        """Number of bytes currently held by the cache."""
+        return self._nbytes
+
+    def get(self, key):
+        """Retrieve an array from the cache.
+
+        :return: the cached array, or ``None`` if the key is not present.
+        """
+        with self._lock:
+            if key not in self._items:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value):
+        """Store an array in the cache, evicting the least recently used
+        entries if the budget is exceeded. Arrays larger than the budget are
+        not stored, and are returned unchanged.
+
+        :return: the array, read-only if it was stored.
+        """
+        nbytes = array_nbytes(value)
+        if nbytes > self.max_bytes:
+            return value
+
+        set_read_only(value)
+        with self._lock:
+            if key in self._items:
+                self._nbytes -= array_nbytes(self._items.pop(key))
+
+            self._items[key] = value
+            self._nbytes += nbytes
+
+            while self._nbytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._nbytes -= array_nbytes(evicted)
+                self.evictions += 1
+
+        return value
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        with self._lock:
+            self._items.clear()
+            self._nbytes = 0
+
+    @property
+    def stats(self):
+        """Dictionary with the hit/miss counters and current size."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._items),
+            'bytes': self._nbytes
+        }
+
+
+def fingerprint(paths, *args):
+    """Compute a key from the identity of a set of files (path, size and
+    modification time) and any additional arguments, which should have a
+    stable `repr`.
+
+    :return: hexadecimal digest.
+    """
+    h = hashlib.sha1()
+    for path in sorted(str(p) for p in paths):
+        stat = os.stat(path)
+        h.update(repr((path, stat.st_size, stat.st_mtime_ns)).encode())
+    h.update(repr(args).encode())
+    return h.hexdigest()
+
+
+def data_fingerprint(arrays, *args):
+    """Compute a key from the contents of a set of arrays and any additional
+    arguments, which should have a stable `repr`. Of
+    :py:class:`~hypercc.data.masked.MaskedData` and masked arrays both data
+    and mask are included.
+
+    :return: hexadecimal digest.
+    """
+    h = hashlib.sha1()
+    for a in arrays:
+        if isinstance(a, MaskedData):
+            parts = [a.data, a.mask]
+        elif isinstance(a, np.ma.MaskedArray):
+            parts = [np.ma.getdata(a), np.ma.getmaskarray(a)]
+        else:
+            parts = [np.asarray(a)]
+        for part in parts:
+            h.update(repr((part.dtype.str, part.shape)).encode())
+            # one time step at a time, to avoid copying the whole array
+            for plane in (part if part.ndim > 1 else [part]):
+                h.update(np.ascontiguousarray(plane))
+    h.update(repr(args).encode())
+    return h.hexdigest()
+
+
+class DiskCache(object):
+    """Content-addressed cache of preprocessed arrays on disk. Each entry is
+    a directory holding the data as raw ``data.npy``, the mask (if any) as
+    ``mask.npy`` and the :py:class:`Box` pickled in ``box.pickle``. Masked
+    data is stored as :py:class:`~hypercc.data.masked.MaskedData`, so a
+    mask that is the same for every time step takes two dimensions only.
+
+    Arrays are memory-mapped read-only when loaded, so that concurrent
+    processes working on the same inputs share pages.
+
+    :param path: folder holding the cache.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, key):
+        """Load an entry from the cache.
+
+        :return: tuple (box, data), or ``None`` if the key is not present.
+        """
+        entry = self.path / key
+        if not entry.exists():
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        # plain ndarray views on the maps, so that results can be pickled
+        data = np.load(str(entry / 'data.npy'), mmap_mode='r') \
+            .view(np.ndarray)
+        if (entry / 'mask.npy').exists():
+            mask = np.load(str(entry / 'mask.npy'), mmap_mode='r') \
+                .view(np.ndarray)
+            data = MaskedData(data, mask)
+        with (entry / 'box.pickle').open('rb') as f:
+            box = pickle.load(f)
+        return box, data
+
+    def store(self, key, box, data):
+        """Store an entry in the cache. The entry is written to a temporary
+        folder first and then moved in place, so that readers never see a
+        partial entry."""
+        entry = self.path / key
+        if entry.exists():
+            return
+
+        tmp = Path(tempfile.mkdtemp(dir=str(self.path)))
+        if isinstance(data, MaskedData):
+            np.save(str(tmp / 'data.npy'), data.data)
+            np.save(str(tmp / 'mask.npy'), data.mask)
+        else:
+            np.save(str(tmp / 'data.npy'), data)
+        with (tmp / 'box.pickle').open('wb') as f:
+            pickle.dump(box, f)
+
+        try:
+            os.rename(str(tmp), str(entry))
+        except OSError:
+            # another process stored the same entry in the mean time
+            shutil.rmtree(str(tmp))
+
+    @property
+    def stats(self):
+        """Dictionary with the hit/miss counters."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses
+        }
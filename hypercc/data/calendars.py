@@ -0,0 +1,78 @@
+"""
+Vectorised conversion of NetCDF time axes to dates, for the calendars
+found in CMIP5 data.
+"""
+
+from datetime import date
+
+import numpy as np
+
+
+SECONDS = {
+    'days': 86400, 'day': 86400, 'd': 86400,
+    'hours': 3600, 'hour': 3600, 'h': 3600,
+    'minutes': 60, 'minute': 60,
+    'seconds': 1, 'second': 1, 's': 1}
+"""Length of the time units in seconds."""
+
+MONTH_LENGTHS = {
+    'noleap': [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31],
+    'all_leap': [31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31],
+    '360_day': [30] * 12}
+"""Month lengths of calendars that have the same length every year."""
+
+CALENDAR_ALIASES = {
+    'standard': 'gregorian',
+    'proleptic_gregorian': 'gregorian',
+    'julian': 'gregorian',
+    '365_day': 'noleap',
+    '366_day': 'all_leap'}
+
+
+def decode_time(values, units, start, calendar='standard'):
+    """Convert time values of the form "<units> since <start>" into years,
+    months and days in the given calendar. Fractions of days are
+    discarded. The Julian calendar is treated as Gregorian.
+
+    :param values: array of time values.
+    :param units: time unit, e.g. 'days'.
+    :param start: :py:class:`datetime.date` of the time origin.
+    :param calendar: CF calendar name.
+    :return: tuple of three integer arrays (years, months, days).
+    """
+    days = np.floor(
+        np.asarray(values, dtype='float64') * SECONDS[units] / 86400) \
+        .astype('int64')
+    calendar = calendar.lower()
+    calendar = CALENDAR_ALIASES.get(calendar, calendar)
+
+    if calendar == 'gregorian':
+        t = np.datetime64(start, 'D') + days.astype('timedelta64[D]')
+        month = t.astype('datetime64[M]')
+        years = month.astype('datetime64[Y]').astype('int64') + 1970
+        months = month.astype('int64') % 12 + 1
+        return years, months, (t - month).astype('int64') + 1
+
+    try:
+        lengths = np.array(MONTH_LENGTHS[calendar])
+    except KeyError:
+        raise ValueError("Unsupported calendar: {}".format(calendar))
+
+    first_day = np.r_[0, np.cumsum(lengths)]
+    day_number = days + first_day[start.month - 1] + start.day - 1
+    years, day_of_year = np.divmod(day_number, first_day[-1])
+    months = np.searchsorted(first_day, day_of_year, side='right')
+    return years + start.year, months, day_of_year - first_day[months - 1] + 1
+
+
+def to_dates(years, months, days):
+    """Convert arrays of years, months and days to a list of
+    :py:class:`datetime.date` objects. Days that do not exist in the
+    Gregorian calendar (e.g. February 30 in a 360-day calendar) are moved to
+    the last day of the month."""
+    month = (np.asarray(years) - 1970) * 12 + np.asarray(months) - 1
+    month = month.astype('datetime64[M]')
+    month_length = ((month + 1).astype('datetime64[D]')
+                    - month.astype('datetime64[D]')).astype('int64')
+    return [date(int(y), int(m), int(d)) for y, m, d in zip(
+        years, months, np.minimum(days, month_length))]
@@ -0,0 +1,175 @@
+"""
+Persistent index of the CMIP5 files in an archive, stored in SQLite.
+"""
+
+import os
+import re
+import sqlite3
+from pathlib import Path
+
+import netCDF4
+
+
+CMIP5_FILENAME = re.compile(
+    r'^(?P<variable>[^_]+)_(?P<table>[^_]*mon)_(?P<model>[^_]+)_'
+    r'(?P<scenario>[^_]+)_(?P<realization>[^_]+)_'
+    r'(?P<start>\d{6})-(?P<end>\d{6})\.(?P<extension>.+)$')
+"""Regular expression matching CMIP5 file names, as searched for by
+:py:meth:`DataSet.cmip5`."""
+
+SCHEMA = """
+create table if not exists directories (
+    path text primary key,
+    mtime real not null
+);
+create table if not exists files (
+    path text primary key,
+    directory text not null,
+    model text not null,
+    scenario text not null,
+    variable text not null,
+    realization text not null,
+    extension text not null,
+    time_start integer not null,
+    time_end integer not null,
+    n_time integer,
+    n_lat integer,
+    n_lon integer,
+    size integer not null,
+    mtime real not null
+);
+create index if not exists files_query on files (
+    directory, variable, model, scenario, realization, extension);
+"""
+
+
+def grid_shape(path, variable):
+    """Read the shape of a variable from a NetCDF file. Returns ``None``
+    if the file cannot be read or the variable is not three-dimensional."""
+    try:
+        with netCDF4.Dataset(str(path), 'r') as nc:
+            shape = nc.variables[variable].shape
+    except (OSError, KeyError):
+        return None
+    return shape if len(shape) == 3 else None
+
+
+class Catalogue(object):
+    """Index of CMIP5 files, stored in an SQLite database. Scanning an
+    archive only revisits directories whose modification time changed
+    since the last scan.
+
+    :param path: location of the database file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(str(path))
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def scan(self, root):
+        """Index all CMIP5 files below `root`.
+
+        :param root: root folder of the archive.
+        :return: number of directories that were (re)indexed.
+        """
+        root = str(Path(root).resolve())
+        seen = set()
+        n_indexed = 0
+
+        for directory, _, filenames in os.walk(root):
+            seen.add(directory)
+            mtime = os.stat(directory).st_mtime
+            row = self.db.execute(
+                "select mtime from directories where path = ?",
+                (directory,)).fetchone()
+            if row is not None and row[0] == mtime:
+                continue
+
+            self.index_directory(directory, filenames, mtime)
+            n_indexed += 1
+
+        # compare prefixes literally: in a like pattern, '_' and '%' in
+        # the root would match other directories
+        prefix = root + os.sep
+        gone = [path for (path,) in self.db.execute(
+                    "select path from directories where path = ? "
+                    "or substr(path, 1, ?) = ?", (root, len(prefix), prefix))
+                if path not in seen]
+        with self.db:
+            for path in gone:
+                self.db.execute(
+                    "delete from files where directory = ?", (path,))
+                self.db.execute(
+                    "delete from directories where path = ?", (path,))
+
+        return n_indexed
+
+    def index_directory(self, directory, filenames, mtime):
+        """Update the entries for the files in a single directory. Files that
+        did not change size or modification time keep their entry.
+
+        :param directory: absolute path of the directory.
+        :param filenames: names of the files in the directory.
+        :param mtime: modification time of the directory.
+        """
+        known = {
+            path: (size, file_mtime) for path, size, file_mtime
+            in self.db.execute(
+                "select path, size, mtime from files where directory = ?",
+                (directory,))}
+
+        rows = []
+        for name in filenames:
+            match = CMIP5_FILENAME.match(name)
+            if not match:
+                continue
+
+            path = os.path.join(directory, name)
+            stat = os.stat(path)
+            if known.pop(path, None) == (stat.st_size, stat.st_mtime):
+                continue
+
+            shape = grid_shape(path, match['variable']) or (None,) * 3
+            rows.append((
+                path, directory, match['model'], match['scenario'],
+                match['variable'], match['realization'], match['extension'],
+                int(match['start']), int(match['end'])) + tuple(shape) +
+                (stat.st_size, stat.st_mtime))
+
+        with self.db:
+            self.db.executemany(
+                "insert or replace into files values "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.db.executemany(
+                "delete from files where path = ?", [(p,) for p in known])
+            self.db.execute(
+                "insert or replace into directories values (?, ?)",
+                (directory, mtime))
+
+    def indexed(self, directory):
+        """Check whether a directory is present in the catalogue."""
+        return self.db.execute(
+            "select 1 from directories where path = ?",
+            (str(Path(directory).resolve()),)).fetchone() is not None
+
+    def find(self, directory, model, variable, scenario, realization,
+             extension='nc'):
+        """Look up the files of a data set in a given directory.
+
+        :return: list of paths.
+        """
+        return [Path(path) for (path,) in self.db.execute(
+            "select path from files where directory = ? and variable = ? "
+            "and model = ? and scenario = ? and realization = ? "
+            "and extension = ? order by time_start",
+            (str(Path(directory).resolve()), variable, model, scenario,
+             realization, extension))]
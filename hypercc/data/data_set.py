@@ -7,8 +7,11 @@ from copy import copy
 
 import numpy as np
 
-from .file import File
+from .file import File, range_to_slice, read_metadata_concurrently
 from .box import Box
+from .cache import selection_key, fingerprint
+from .masked import MaskedData, compact_mask, concatenate
+from .. import memory
 
 
 def overlap_idx(t1, t2):
@@ -24,33 +27,118 @@ def overlap_idx(t1, t2):
         return slice(0, idx[0])
 
 
+SEASONS = {'djf': 11, 'mam': 2, 'jja': 5, 'son': 8}
+"""Index of the first month of each meteorological season, counting from
+January. Winter (DJF) starts in December and ends in February of the next
+year."""
+
+
+def split_selection(lengths, selection):
+    """Distribute a slice on a concatenated axis over its segments.
+
+    :param lengths: lengths of the consecutive segments.
+    :param selection: slice into the concatenated axis.
+    :return: list of tuples ``(i, s)``, where ``s`` is a slice into segment
+        ``i``. Concatenating the selected parts in the order given yields
+        the same result as slicing the concatenated axis.
+    """
+    offsets = np.cumsum([0] + list(lengths))
+    r = range(offsets[-1])[selection]
+    step = abs(r.step)
+
+    parts = []
+    for i, (lo, hi) in enumerate(zip(offsets[:-1], offsets[1:])):
+        # position in `r` of the first and one past the last element
+        # inside [lo, hi)
+        if r.step > 0:
+            k0 = -(-(lo - r.start) // step)
+            k1 = -(-(hi - r.start) // step)
+        else:
+            k0 = -(-(r.start - hi + 1) // step)
+            k1 = -(-(r.start - lo + 1) // step)
+        sub = r[max(k0, 0):max(k1, 0)]
+        if len(sub) == 0:
+            continue
+        parts.append((max(k0, 0), i, range_to_slice(
+            range(sub.start - lo, sub.stop - lo, sub.step))))
+
+    return [(i, s) for _, i, s in sorted(parts)]
+
+
 class LoadedDataSet(object):
-    def __init__(self, box, data):
+    def __init__(self, box, data, interior=None):
         self.box = box
         self.data = data
+        self.interior = interior
 
     def __getitem__(self, s):
         return LoadedDataSet(self.box[s], self.data[s])
 
+    def crop(self):
+        """Remove the halo around a regional data set, see
+        :py:meth:`DataSet.extend_region`."""
+        if self.interior is None:
+            return self
+        return LoadedDataSet(self.box[self.interior], self.data[self.interior])
+
 
 class DataSet(object):
-    def __init__(self, paths, variable, selection=slice(None)):
+    """Series of NetCDF files holding a single variable.
+
+    Loaded arrays can be kept in memory by setting the class attribute
+    :py:attr:`cache` to an instance of
+    :py:class:`~hypercc.data.cache.ArrayCache`. Arrays obtained from the
+    cache are read-only.
+
+    Similarly, loaded arrays are stored on disk, and memory-mapped on
+    subsequent runs, by setting :py:attr:`disk_cache` to an instance of
+    :py:class:`~hypercc.data.cache.DiskCache`.
+
+    With :py:attr:`load_workers` above one, the metadata of the files is
+    read concurrently on a pool of processes. The files are opened for
+    reading data on first use.
+
+    Data is converted to the floating point type :py:attr:`dtype` on
+    reading. The filters and the calibration compute in the type of their
+    input, so this sets the precision of the whole analysis.
+    """
+    cache = None
+    disk_cache = None
+    load_workers = 1
+    dtype = 'float32'
+
+    def __init__(self, paths, variable, selection=slice(None),
+                 window=None, interior=None):
         self.files = None
         self.paths = paths
         self.variable = variable
         self.selection = selection
+        self.window = window
+        self.interior = interior
         self._box = None
 
         self.check_and_load()
 
     @staticmethod
     def cmip5(path, model: str, variable: str, scenario: str,
-              realization: str, extension="nc", selection=slice(None)):
+              realization: str, extension="nc", selection=slice(None),
+              catalogue=None):
+        """Open the files of a CMIP5 data set in the given folder.
+
+        :param catalogue: optional :py:class:`~hypercc.data.catalogue.\
+Catalogue`; if the folder is indexed there, the files are looked up in
+            the catalogue in stead of searching the folder.
+        """
         pattern = "{variable}_*mon_{model}_{scenario}_{realization}_" \
                   "??????-??????.{extension}".format(
                       variable=variable, model=model, scenario=scenario,
                       realization=realization, extension=extension)
-        paths = list(Path(path).glob(pattern))
+        if catalogue is not None and catalogue.indexed(path):
+            paths = catalogue.find(
+                path, model=model, variable=variable, scenario=scenario,
+                realization=realization, extension=extension)
+        else:
+            paths = list(Path(path).glob(pattern))
         if not paths:
             print("No file found matching pattern\n    {}"
                   "\nin directory\n    {}\n".format(
@@ -63,7 +151,9 @@ class DataSet(object):
         return pack({
             'paths': self.paths,
             'variable': self.variable,
-            'selection': self.selection
+            'selection': self.selection,
+            'window': self.window,
+            'interior': self.interior
         })
 
     @classmethod
@@ -71,10 +161,11 @@ class DataSet(object):
         return DataSet(**data)
 
     def load(self):
-        """Open files, find overlaps."""
-        self.files = sorted(
-            list(map(File, self.paths)),
-            key=lambda f: f.time[0])
+        """Read the metadata of the files concurrently, find overlaps."""
+        metadata = read_metadata_concurrently(self.paths, self.load_workers)
+        files = [File(path, m) for path, m in zip(self.paths, metadata)]
+
+        self.files = sorted(files, key=lambda f: f.time[0])
 
         bounds = [overlap_idx(self.files[i].time, self.files[i+1].time)
                   for i in range(len(self.files) - 1)] + [slice(None)]
@@ -104,11 +195,179 @@ class DataSet(object):
         result.selection = selection
         return result
 
-    def annual_mean(self):
-        shape = (self.box.shape[0] // 12, 12) + self.box.shape[1:]
+    def select_region(self, lat0, lat1, lon0, lon1):
+        """Restrict the data set to a window in latitude and longitude.
+        Only this window is read from disk. The window may wrap around in
+        longitude, for instance ``lon0=300, lon1=30``.
+
+        :param lat0: southern boundary of the window in degrees.
+        :param lat1: northern boundary of the window in degrees.
+        :param lon0: western boundary of the window in degrees.
+        :param lon1: eastern boundary of the window in degrees.
+        :return: new :py:class:`DataSet`.
+
+        Raises:
+        *   ValueError if no grid points are found inside the window.
+        """
+        lat = self._box.lat
+        lat_idx = np.where((lat >= lat0) & (lat <= lat1))[0]
+
+        lon = self._box.lon
+        d_lon = (lon - lon0) % 360
+        width = (lon1 - lon0) % 360 if lon1 - lon0 < 360 else 360
+        lon_idx = np.where(d_lon <= width)[0]
+
+        if len(lat_idx) == 0 or len(lon_idx) == 0:
+            raise ValueError(
+                "No grid points in region {}-{}N, {}-{}E.".format(
+                    lat0, lat1, lon0, lon1))
+
+        result = copy(self)
+        result.window = (int(lat_idx.min()), int(lat_idx.max()) + 1,
+                         int(lon_idx[np.argmin(d_lon[lon_idx])]),
+                         len(lon_idx))
+        result.interior = None
+        return result
+
+    def extend_region(self, n_lat, n_lon):
+        """Extend the window of a regional data set by a halo, so that
+        filters computed on the extended data give the same result inside
+        the original window as on the global data. The halo is clipped at
+        the poles. If the extended window would cover all longitudes, the
+        full circle is read, rotated so that the original window is in the
+        middle.
+
+        :param n_lat: width of the halo in number of grid points in latitude.
+        :param n_lon: width of the halo in number of grid points in
+            longitude.
+        :return: new :py:class:`DataSet`, with :py:attr:`interior` set to
+            the slices selecting the original window from the extended one.
+        """
+        if self.window is None:
+            return self
+
+        lat_start, lat_stop, lon_start, lon_count = self.window
+        n_lon_total = self._box.lon.size
+
+        new_lat_start = max(0, lat_start - n_lat)
+        new_lat_stop = min(self._box.lat.size, lat_stop + n_lat)
+        if lon_count + 2 * n_lon >= n_lon_total:
+            offset = (n_lon_total - lon_count) // 2
+            new_lon_count = n_lon_total
+        else:
+            offset = n_lon
+            new_lon_count = lon_count + 2 * n_lon
+
+        result = copy(self)
+        result.window = (new_lat_start, new_lat_stop,
+                         (lon_start - offset) % n_lon_total, new_lon_count)
+        result.interior = (
+            slice(None),
+            slice(lat_start - new_lat_start, lat_stop - new_lat_start),
+            slice(offset, offset + lon_count))
+        return result
+
+    def crop(self):
+        """Remove the halo added by :py:meth:`extend_region`.
+
+        :return: new :py:class:`DataSet`.
+        """
+        if self.interior is None:
+            return self
+
+        _, lat, lon = self.interior
+        lat_start, _, lon_start, _ = self.window
+        result = copy(self)
+        result.window = (
+            lat_start + lat.start, lat_start + lat.stop,
+            (lon_start + lon.start) % self._box.lon.size,
+            lon.stop - lon.start)
+        result.interior = None
+        return result
+
+    @property
+    def window_index(self):
+        """The window as a latitude slice and a list of longitude slices,
+        or ``None`` if no window is set."""
+        if self.window is None:
+            return None
+
+        lat_start, lat_stop, lon_start, lon_count = self.window
+        n_lon_total = self._box.lon.size
+        lons = [slice(lon_start, min(n_lon_total, lon_start + lon_count))]
+        if lon_start + lon_count > n_lon_total:
+            lons.append(slice(0, lon_start + lon_count - n_lon_total))
+        return slice(lat_start, lat_stop), lons
+
+    def annual_mean(self, block_length=120):
+        """Compute the annual mean, reading only a block of time steps at a
+        time. The data is assumed to start in January.
+
+        :param block_length: maximum number of time steps held in memory.
+        :return: :py:class:`LoadedDataSet`
+        """
+        return self.monthly_mean(0, 12, block_length)
+
+    def seasonal_mean(self, season, block_length=120):
+        """Compute the mean of a meteorological season for each year,
+        reading only a block of time steps at a time. The data is assumed to
+        start in January; the first winter starts in the first December.
+
+        :param season: one of 'djf', 'mam', 'jja', 'son'.
+        :param block_length: maximum number of time steps held in memory.
+        :return: :py:class:`LoadedDataSet`
+        """
+        return self.monthly_mean(SEASONS[season], 3, block_length)
+
+    @memory.stage('monthly mean')
+    def monthly_mean(self, offset, length, block_length=120):
+        """Average groups of `length` consecutive months, one group per year,
+        the first group starting at time step `offset`. Incomplete groups at
+        the end of the series are dropped.
+
+        Running sums are kept for the groups, while the monthly data is read
+        block by block, so a group may be split over several blocks or
+        files.
+
+        :param offset: index of the first month in the first group.
+        :param length: number of months per group.
+        :param block_length: maximum number of time steps held in memory.
+        :return: :py:class:`LoadedDataSet`
+        """
+        n_time = self.box.shape[0]
+        n_groups = max(0, (n_time - offset - length) // 12 + 1)
+        shape = (n_groups,) + self.box.shape[1:]
+        total = np.zeros(shape, dtype='float64')
+        count = np.zeros(shape, dtype='int16')
+        masked = False
+
+        t = 0
+        for block in self.blocks(block_length):
+            group, month = np.divmod(t + np.arange(len(block)) - offset, 12)
+            selected = (group >= 0) & (group < n_groups) & (month < length)
+            if isinstance(block, MaskedData):
+                masked = True
+                valid = np.broadcast_to(~block.mask, block.shape)
+                block = block.filled(0)
+            else:
+                valid = None
+
+            for g in np.unique(group[selected]):
+                idx = selected & (group == g)
+                total[g] += block[idx].sum(axis=0)
+                if valid is None:
+                    count[g] += idx.sum()
+                else:
+                    count[g] += valid[idx].sum(axis=0, dtype='int16')
+            t += len(block)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            data = (total / count).astype(self.dtype)
+        if masked:
+            data = MaskedData(data, compact_mask(count == 0))
+
         return LoadedDataSet(
-            self.box[::12][:shape[0]],
-            self.data[:shape[0]*12].reshape(shape).mean(axis=1).astype('float32'))
+            self.box[offset::12][:n_groups], data, self.interior)
 
     @property
     def box(self):
@@ -147,13 +406,94 @@ class DataSet(object):
                 lon_bnds[-1, 1] += 180
 
             dt, t0 = self.files[0].time_units
-            self._box = Box(time, lat, lon, lat_bnds, lon_bnds, dt, t0)
+            self._box = Box(time, lat, lon, lat_bnds, lon_bnds, dt, t0,
+                            self.files[0].calendar)
+
+        if self.window is None:
+            return self._box[self.selection]
 
-        return self._box[self.selection]
+        lat, lons = self.window_index
+        lon = np.concatenate([np.arange(len(self._box.lon))[s] for s in lons])
+        return self._box[slice(None), lat, lon][self.selection]
+
+    @property
+    def cache_key(self):
+        """Key identifying the data selected from this data set."""
+        return (tuple(sorted(str(p) for p in self.paths)), self.variable,
+                self.window, selection_key(self.selection),
+                np.dtype(self.dtype).str)
 
     @property
     def data(self):
-        """Concatenates data from entire dataset into single array."""
-        return np.ma.concatenate(
-            [f.get_masked(self.variable).astype('float32')
-             for f in self.files])[self.selection]
+        """Concatenates data from entire dataset into single array. If a
+        cache is set, the array is looked up there first."""
+        if DataSet.cache is not None:
+            data = DataSet.cache.get(self.cache_key)
+            if data is not None:
+                return data
+
+        if DataSet.disk_cache is not None:
+            data = self.read_disk_cache()
+        else:
+            data = self.read()
+
+        if DataSet.cache is not None:
+            data = DataSet.cache.put(self.cache_key, data)
+        return data
+
+    def read_disk_cache(self):
+        """Load the data from the disk cache, reading it from the NetCDF
+        files and storing it in the cache if it is not present. The cache
+        key is computed from the path, size and modification time of the
+        files, the variable and the selection."""
+        key = fingerprint(
+            self.paths, 'DataSet', self.variable, self.window,
+            selection_key(self.selection), np.dtype(self.dtype).str)
+        entry = DataSet.disk_cache.load(key)
+        if entry is not None:
+            return entry[1]
+
+        data = self.read()
+        DataSet.disk_cache.store(key, self.box, data)
+        return data
+
+    @memory.stage('read')
+    def read(self):
+        """Concatenates data from entire dataset into single array.
+
+        If the time component of the selection is a slice, it is translated
+        into a hyperslab for each file, so that only the selected time steps
+        are read from disk."""
+        return concatenate(list(self.blocks()))
+
+    def blocks(self, block_length=None):
+        """Iterate over the selected data in consecutive blocks along the time
+        axis. Each block comes from a single file.
+
+        :param block_length: maximum number of time steps in a block; if not
+            given, each file is read in one go.
+        """
+        if isinstance(self.selection, tuple):
+            time_selection, rest = self.selection[0], self.selection[1:]
+        else:
+            time_selection, rest = self.selection, ()
+
+        parts = []
+        if isinstance(time_selection, slice):
+            parts = split_selection(
+                [len(f.time) for f in self.files], time_selection)
+
+        window = self.window_index
+        if not parts:
+            yield concatenate(
+                [f.get_masked(self.variable, window=window).astype(self.dtype)
+                 for f in self.files])[self.selection]
+            return
+
+        for i, s in parts:
+            r = range(len(self.files[i].time))[s]
+            step = block_length or len(r)
+            for j in range(0, len(r), step):
+                yield self.files[i].get_masked(
+                    self.variable, (range_to_slice(r[j:j+step]),) + rest,
+                    window).astype(self.dtype)
@@ -2,12 +2,29 @@
 Functionality for reading and interpreting single NetCDF files.
 """
 
+from concurrent.futures import ProcessPoolExecutor
 from datetime import date
+import multiprocessing
+import threading
 
 import netCDF4
 from pyparsing import Word, Suppress, Group, tokenMap, alphas, nums
 import numpy as np
 
+from .masked import MaskedData
+
+p_int = Word(nums).setParseAction(tokenMap(int))
+p_date = Group(p_int('year') + Suppress('-') +
+               p_int('month') + Suppress('-') +
+               p_int('day'))('date').setParseAction(
+                   tokenMap(lambda args: date(*args)))
+p_time_unit = Word(alphas)('units') + Suppress("since") + p_date
+
+NETCDF_LOCK = threading.RLock()
+"""The NetCDF-C and HDF5 libraries are not thread-safe, while the `netCDF4`
+module releases the GIL when calling into them. All access to NetCDF files
+should hold this lock."""
+
 
 def parse_time_units(units):
     """Parse time unit string from a NetCDF file. Such a string may look like::
@@ -20,16 +37,69 @@ def parse_time_units(units):
 
     Returns: 2-tuple (unit string, datetime object)
     """
-    p_int = Word(nums).setParseAction(tokenMap(int))
-    p_date = Group(p_int('year') + Suppress('-') +
-                   p_int('month') + Suppress('-') +
-                   p_int('day'))('date').setParseAction(
-                       tokenMap(lambda args: date(*args)))
-    p_time_unit = Word(alphas)('units') + Suppress("since") + p_date
     result = p_time_unit.parseString(units)
     return result['units'], result['date'][0]
 
 
+def range_to_slice(r):
+    """Convert a `range` object to a slice selecting the same elements."""
+    return slice(r.start, r.stop if r.stop >= 0 else None, r.step)
+
+
+def dataset_metadata(data):
+    """Read the coordinate axes, their bounds and the time units from an
+    open `netCDF4.Dataset`. Bounds are ``None`` if the file does not
+    specify them. The caller should hold :py:data:`NETCDF_LOCK`."""
+    variables = data.variables
+
+    def get(name):
+        return variables[name][:] if name in variables else None
+
+    return {
+        'time': variables['time'][:],
+        'time_units': parse_time_units(variables['time'].units),
+        'calendar': getattr(variables['time'], 'calendar', 'standard'),
+        'lat': variables['lat'][:],
+        'lon': variables['lon'][:],
+        'lat_bnds': get('lat_bnds'),
+        'lon_bnds': get('lon_bnds')
+    }
+
+
+def read_metadata(path):
+    """Open a NetCDF file, read its metadata (see
+    :py:func:`dataset_metadata`) and close it again. The result holds plain
+    arrays only, so that this can run in another process."""
+    with NETCDF_LOCK:
+        with netCDF4.Dataset(str(path), 'r', format='NETCDF4') as data:
+            return dataset_metadata(data)
+
+
+def read_metadata_concurrently(paths, workers):
+    """Read the metadata of several files on a pool of `workers`
+    processes. The NetCDF library runs one call at a time within a process,
+    so only separate processes overlap the opening of files, which can be
+    slow on mounted drives. The pool is started for each call and shut
+    down when all files are read. Its processes are spawned, so scripts
+    using it need the ``if __name__ == '__main__'`` guard.
+
+    :param paths: paths of the files.
+    :param workers: number of processes; with one worker or a single file
+        the metadata is read in this process.
+    :return: list of metadata dictionaries, in the order of `paths`.
+    """
+    paths = [str(p) for p in paths]
+    if workers <= 1 or len(paths) <= 1:
+        return [read_metadata(p) for p in paths]
+
+    # spawn, since forking a process that holds NetCDF or HDF5 state,
+    # possibly in use by other threads, is not safe
+    with ProcessPoolExecutor(
+            max_workers=min(workers, len(paths)),
+            mp_context=multiprocessing.get_context('spawn')) as pool:
+        return list(pool.map(read_metadata, paths))
+
+
 class File(object):
     """Interface to single NetCDF4 file with bounds set on the time.
 
@@ -38,61 +108,135 @@ class File(object):
     ``bounds`` property in this object to limit data to the needed time slots.
     Combining the limited datasets will result in a a nice contiguous dataset.
     """
-    def __init__(self, f):
+    def __init__(self, f, metadata=None):
         self.path = f
-        # pylint: disable=E1101
-        self.data = netCDF4.Dataset(f, 'r', format='NETCDF4')
         self.bounds = slice(None)
+        self._data = None
+        self._metadata = metadata
+
+    @property
+    def data(self):
+        """The `netCDF4.Dataset`, opened on first access."""
+        with NETCDF_LOCK:
+            if self._data is None:
+                # pylint: disable=E1101
+                self._data = netCDF4.Dataset(
+                    self.path, 'r', format='NETCDF4')
+            return self._data
+
+    @property
+    def metadata(self):
+        """Dictionary with the coordinate axes, their bounds and the time
+        units, as returned by :py:func:`dataset_metadata`. These are read
+        from the file on first access only, unless given on construction."""
+        if self._metadata is None:
+            with NETCDF_LOCK:
+                self._metadata = dataset_metadata(self.data)
+        return self._metadata
+
+    def _bounds_metadata(self, name):
+        value = self.metadata[name]
+        if value is None:
+            raise KeyError(name)
+        return value
 
     @property
     def time(self):
         """Returns the time variable restricted to the given bounds."""
-        return self.data.variables['time'][self.bounds]
+        return self.metadata['time'][self.bounds]
 
     @property
     def lat(self):
         """Returns the latitudes of the grid."""
-        return self.data.variables['lat'][:]
+        return self.metadata['lat']
 
     @property
     def lon(self):
         """Returns the longitudes of the grid."""
-        return self.data.variables['lon'][:]
+        return self.metadata['lon']
 
     @property
     def lat_bnds(self):
         """Returns the latitude intervals of the grid."""
-        return self.data.variables['lat_bnds'][:]
+        return self._bounds_metadata('lat_bnds')
 
     @property
     def lon_bnds(self):
         """Returns the longitude intervals of the grid."""
-        return self.data.variables['lon_bnds'][:]
+        return self._bounds_metadata('lon_bnds')
+
+    def time_index(self, selection=slice(None)):
+        """Translate a slice relative to the bounded time axis into a slice
+        on the time dimension of the NetCDF variable.
 
-    def get(self, var):
+        :param selection: slice into the time axis, as returned by
+            :py:attr:`time`.
+        :return: slice that can be given directly to the NetCDF reader.
+        """
+        return range_to_slice(
+            range(len(self.metadata['time']))[self.bounds][selection])
+
+    def get(self, var, selection=slice(None), window=None):
         """Get the values of a given variable limited to the time bounds set.
+
+        :param var: name of the variable.
+        :param selection: slice into the bounded time axis, optionally
+            followed by indices into the remaining dimensions. Only the
+            selected hyperslab is read from disk.
+        :param window: optional tuple of a latitude slice and a list of
+            longitude slices. Only this window is read from disk; the
+            longitude parts are joined in the order given, which allows
+            for windows wrapping around in longitude. Indices in
+            ``selection`` beyond the time axis are then relative to the
+            window.
         """
-        return self.data.variables[var][self.bounds]
+        if not isinstance(selection, tuple):
+            selection = (selection,)
+        index = (self.time_index(selection[0]),) + selection[1:]
+        with NETCDF_LOCK:
+            if window is None:
+                return self.data.variables[var][index]
+
+            lat, lons = window
+            parts = [self.data.variables[var][index[0], lat, lon]
+                     for lon in lons]
+        if len(parts) == 1:
+            data = parts[0]
+        else:
+            data = np.ma.concatenate(parts, axis=-1)
+        return data[(slice(None),) + index[1:]]
 
-    def get_masked(self, var):
+    def get_masked(self, var, selection=slice(None), window=None):
         """The NetCDF file may specify a floating point value for missing
         values, for instance in the case of variables that only have valid
-        entries on sea or land cells. In this case we'd like to obtain a
-        masked array in stead of a normal ndarray object.
+        entries on sea or land cells. In this case we'd like to obtain the
+        data together with a mask.
+
+        This function returns a :py:class:`~hypercc.data.masked.MaskedData`
+        for the given variable; the mask is stored in two dimensions if it
+        is the same for every time step. When no mask is needed, a normal
+        numpy array is returned.
 
-        This function returns a masked array for the given variable. When no
-        mask is needed, a normal numpy array is returned.
+        :param var: name of the variable.
+        :param selection: see :py:meth:`get`.
+        :param window: see :py:meth:`get`.
         """
-        data = self.data.variables[var][self.bounds]
-        missing_value = self.data.variables[var].missing_value
+        data = self.get(var, selection, window)
+        with NETCDF_LOCK:
+            missing_value = self.data.variables[var].missing_value
         masked_data = np.ma.masked_equal(data, missing_value)
         if masked_data.mask is np.ma.nomask:
             return masked_data.data
         else:
-            return masked_data
+            return MaskedData.from_masked_array(masked_data)
+
+    @property
+    def calendar(self):
+        """Obtain the calendar of the time axis from the NetCDF"""
+        return self.metadata['calendar']
 
     @property
     def time_units(self):
         """Obtain time units from the NetCDF"""
-        dt, t0 = parse_time_units(self.data.variables['time'].units)
+        dt, t0 = self.metadata['time_units']
         return dt, t0
@@ -0,0 +1,151 @@
+"""
+Compact representation of masked data, for masks that do not change in time.
+"""
+
+import numpy as np
+
+
+def compact_mask(mask):
+    """Reduce a (time x lat x lon) mask to a single (lat x lon) plane if it
+    is the same for every time step, as is the case for land-sea masks.
+
+    :param mask: boolean array.
+    :return: the reduced mask, or the original if it varies in time.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    if mask.ndim > 2 and len(mask) > 0 and (mask == mask[:1]).all():
+        return mask[0]
+    return mask
+
+
+def get_data(a):
+    """Return the data of a :py:class:`MaskedData` or masked array, or the
+    array itself if it is a normal ndarray."""
+    if isinstance(a, MaskedData):
+        return a.data
+    return np.ma.getdata(a)
+
+
+def concatenate(arrays):
+    """Concatenate arrays along the time axis. If any of the arrays is a
+    :py:class:`MaskedData`, the result is too; the mask is kept in two
+    dimensions if it is the same for all parts.
+
+    :param arrays: sequence of ndarray and/or :py:class:`MaskedData`.
+    """
+    if not any(isinstance(a, MaskedData) for a in arrays):
+        return np.concatenate(arrays)
+
+    data = np.concatenate([get_data(a) for a in arrays])
+    masks = [a.mask if isinstance(a, MaskedData)
+             else np.zeros(a.shape[1:], dtype=bool) for a in arrays]
+    if all(m.ndim == 2 for m in masks) and \
+            all((m == masks[0]).all() for m in masks[1:]):
+        return MaskedData(data, masks[0])
+
+    return MaskedData(data, np.concatenate(
+        [np.broadcast_to(m, a.shape) for m, a in zip(masks, arrays)]))
+
+
+class MaskedData(object):
+    """Dense array together with a mask that is broadcast over its trailing
+    axes. For a land-sea mask, a single (lat x lon) mask then serves every
+    time step, and every component of the Sobel output, in stead of storing
+    a copy per element as :py:class:`numpy.ma.MaskedArray` does. A mask
+    that does change in time is stored with the full shape.
+
+    Indexing applies to the data in the leading axes, that the mask does
+    not cover, and to both data and mask in the trailing axes.
+
+    :param data: ndarray.
+    :param mask: boolean array, True where data is invalid; its shape
+        should equal the trailing part of ``data.shape``.
+    """
+    def __init__(self, data, mask):
+        mask = np.asarray(mask, dtype=bool)
+        if data.shape[data.ndim - mask.ndim:] != mask.shape:
+            raise ValueError(
+                "Mask of shape {} does not match data of shape {}."
+                .format(mask.shape, data.shape))
+        self.data = data
+        self.mask = mask
+
+    @staticmethod
+    def from_masked_array(a):
+        """Convert a :py:class:`numpy.ma.MaskedArray`, reducing the mask to
+        two dimensions if possible."""
+        return MaskedData(
+            np.ma.getdata(a), compact_mask(np.ma.getmaskarray(a)))
+
+    def to_masked_array(self):
+        """Convert to a :py:class:`numpy.ma.MaskedArray`. The mask is
+        expanded to the full shape."""
+        return np.ma.MaskedArray(self.data, self.full_mask.copy())
+
+    @property
+    def full_mask(self):
+        """Read-only view on the mask, broadcast to the shape of the data."""
+        return np.broadcast_to(self.mask, self.data.shape)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def ndim(self):
+        return self.data.ndim
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def nbytes(self):
+        """Number of bytes in the data, not counting the mask."""
+        return self.data.nbytes
+
+    def __len__(self):
+        return len(self.data)
+
+    def _mask_index(self, s):
+        if not isinstance(s, tuple):
+            s = (s,)
+        n_lead = self.data.ndim - self.mask.ndim
+        return s[n_lead:] if len(s) > n_lead else ()
+
+    def __getitem__(self, s):
+        return MaskedData(self.data[s], self.mask[self._mask_index(s)])
+
+    def __setitem__(self, s, value):
+        self.data[s] = get_data(value)
+
+    def copy(self):
+        return MaskedData(self.data.copy(), self.mask.copy())
+
+    def astype(self, dtype):
+        return MaskedData(self.data.astype(dtype), self.mask)
+
+    def setflags(self, **kwargs):
+        """Set the flags of both data and mask, see
+        :py:meth:`numpy.ndarray.setflags`."""
+        self.data.setflags(**kwargs)
+        self.mask.setflags(**kwargs)
+
+    def compressed(self):
+        """Return the valid values as a 1-D array, in the same order as
+        :py:meth:`numpy.ma.MaskedArray.compressed`."""
+        return self.data[..., ~self.mask].ravel()
+
+    def filled(self, fill_value=0):
+        """Return a copy of the data with invalid values replaced."""
+        result = self.data.copy()
+        result[..., self.mask] = fill_value
+        return result
+
+    def min(self):
+        """Minimum over the valid values."""
+        return self.compressed().min()
+
+    def max(self):
+        """Maximum over the valid values."""
+        return self.compressed().max()
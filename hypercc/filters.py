@@ -2,13 +2,118 @@
 Implements different filters on spherical grid.
 """
 
+from concurrent.futures import ThreadPoolExecutor
 import sys
+import tempfile
+import warnings
 
 import numpy as np
-from scipy import ndimage
+from scipy import ndimage, fft
 
+from .data.masked import MaskedData, compact_mask, get_data
+from . import memory
 
-def gaussian_filter_2d(box, data, sigma_lat, sigma_lon):
+
+SMOOTHING_ENGINES = ('ndimage', 'fft')
+"""Available methods for the Gaussian smoothing along longitude, see
+:py:func:`gaussian_filter`."""
+
+FFT_BANDS = 8
+"""Number of longitude bands in which the fft engine filters along time,
+see :py:func:`gaussian_filter_3d`."""
+
+TAPER_METHODS = ('iterative', 'nearest', 'normalised')
+"""Available methods for filling the masked area, see
+:py:func:`taper_masked_area`."""
+
+
+def map_blocks(function, n, workers=None):
+    """Split ``range(n)`` into contiguous blocks and call `function` with
+    a slice for each block, on a pool of threads. The filters in
+    :py:mod:`scipy.ndimage` and :py:mod:`scipy.fft` release the GIL, so
+    blocks that write to disjoint parts of a shared output run in parallel.
+
+    :param function: callable taking a slice.
+    :param n: length of the axis to split.
+    :param workers: number of threads; if None or 1, `function` is called
+        once with the full range.
+    """
+    if workers is None or workers <= 1 or n <= 1:
+        function(slice(0, n))
+        return
+
+    bounds = np.linspace(0, n, min(workers, n) + 1).astype(int)
+    blocks = [slice(a, b) for a, b in zip(bounds[:-1], bounds[1:])]
+    with ThreadPoolExecutor(max_workers=len(blocks)) as pool:
+        # consume the results to raise exceptions from the threads
+        list(pool.map(function, blocks))
+
+
+def map_tiles(function, tiles, workers=None):
+    """Call `function` on each tile, on a pool of threads. Unlike
+    :py:func:`map_blocks` the tiles are handed out one at a time, which
+    balances the load when their cost varies.
+
+    :param function: callable taking a tile.
+    :param tiles: sequence of tiles, e.g. slices.
+    :param workers: number of threads; if None or 1, the tiles are
+        processed in turn.
+    :return: list of results, in the order of `tiles`.
+    """
+    if workers is None or workers <= 1 or len(tiles) <= 1:
+        return [function(t) for t in tiles]
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(tiles))) as pool:
+        return list(pool.map(function, tiles))
+
+
+def periodic_gaussian_transfer(sigmas, n, truncate=4.0):
+    """Fourier transform of the Gaussian kernels used by
+    :py:func:`scipy.ndimage.gaussian_filter1d`, wrapped onto a periodic
+    axis of length `n`. Multiplying the spectrum of a signal by this
+    transfer function gives the same result as filtering it with
+    ``mode='wrap'``, for any sigma.
+
+    :param sigmas: sequence of sigmas, in pixels.
+    :param n: length of the periodic axis.
+    :param truncate: truncation of the kernel in units of sigma.
+    :return: real array of shape ``(len(sigmas), n // 2 + 1)``.
+    """
+    result = np.zeros((len(sigmas), n // 2 + 1))
+    kernel = np.zeros(n)
+    for i, sigma in enumerate(sigmas):
+        if sigma == 0:
+            # no smoothing, as in ndimage; the transform of a delta peak
+            result[i] = 1.0
+            continue
+        radius = int(truncate * sigma + 0.5)
+        x = np.arange(-radius, radius + 1)
+        weights = np.exp(-0.5 / sigma**2 * x**2)
+        kernel[:] = 0.0
+        np.add.at(kernel, x % n, weights / weights.sum())
+        # the kernel is symmetric, so its transform is real
+        result[i] = fft.rfft(kernel).real
+    return result
+
+
+def gaussian_filter_periodic(data, sigmas, workers=None):
+    """Filter data along its last, periodic, axis with a different Gaussian
+    for each index along the second to last axis, using one batched FFT.
+
+    :param data: ndarray of shape ``(..., len(sigmas), n)``.
+    :param sigmas: sequence of sigmas, in pixels.
+    :param workers: number of threads used by :py:mod:`scipy.fft`.
+    :return: ndarray of the same shape and type as `data`.
+    """
+    n = data.shape[-1]
+    transfer = periodic_gaussian_transfer(sigmas, n).astype(data.dtype)
+    spectrum = fft.rfft(data, axis=-1, workers=workers)
+    spectrum *= transfer
+    return fft.irfft(spectrum, n=n, axis=-1, workers=workers)
+
+
+def gaussian_filter_2d(box, data, sigma_lat, sigma_lon, engine='ndimage',
+                       workers=None):
     """Filters a 2D (lat x lon) data set with a Gaussian, correcting for
     the distortion from the geographic projection.
 
@@ -16,28 +121,52 @@ def gaussian_filter_2d(box, data, sigma_lat, sigma_lon):
     :param data: data set, dimensions should match ``box.shape``.
     :param sigma_lat: sigma lat in dimension of distance (e.g. km).
     :param sigma_lon: sigma lon in dimension of distance (e.g. km).
+    :param engine: method for smoothing along longitude, see
+        :py:func:`gaussian_filter`.
+    :param workers: number of threads, see :py:func:`gaussian_filter`.
     :return: :py:class:`numpy.ndarray` with the same shape as input.
     """
     res_lat, res_lon = box.resolution
     s_lat = (sigma_lat / res_lat).m_as('')
     s_lon = (sigma_lon / res_lon).m_as('')
+    s_rows = [min(data.shape[1], s_lon / np.cos(lat_rad))
+              for lat_rad in box.lat / 180 * np.pi]
 
     outp = np.zeros_like(data)
 
-    for i, lat_rad in enumerate(box.lat / 180 * np.pi):
+    def filter_rows(rows):
+        for i in range(rows.start, rows.stop):
+            ndimage.gaussian_filter(
+                data[i, :], s_rows[i], mode=['wrap'], output=outp[i, :])
+
+    def filter_lat(lon):
         ndimage.gaussian_filter(
-            data[i, :],
-            min(data.shape[1], s_lon / np.cos(lat_rad)),
-            mode=['wrap'],
-            output=outp[i, :])
+            outp[:, lon], [s_lat, 0.0], mode='constant', output=outp[:, lon])
+
+    if engine == 'fft':
+        outp[:] = gaussian_filter_periodic(data, s_rows, workers)
+    else:
+        map_blocks(filter_rows, len(s_rows), workers)
 
-    ndimage.gaussian_filter(
-        outp, [s_lat, 0.0], mode=['constant', 'wrap'], output=outp)
+    map_blocks(filter_lat, data.shape[1], workers)
 
     return outp
 
 
-def gaussian_filter_3d(box, data, sigma_t, sigma_lat, sigma_lon):
+def row_sigmas(box, s_lon, n_lon):
+    """Sigma of the Gaussian along each latitude row of a 3D box, in pixels,
+    widened by the cosine of the latitude.
+
+    :param box: :py:class:`Box` instance.
+    :param s_lon: sigma along longitude at the equator, in pixels.
+    :param n_lon: number of longitudes; caps the sigma.
+    """
+    return [min(n_lon, s_lon / np.cos(lat_rad))
+            for lat_rad in box.lat_bnds.mean(axis=1) / 180 * np.pi]
+
+
+def gaussian_filter_3d(box, data, sigma_t, sigma_lat, sigma_lon,
+                       engine='ndimage', workers=None):
     """Filters a 3D (time x lat x lon) data set with a Gaussian, correcting for
     the distortion from the geographic projection.
 
@@ -46,29 +175,95 @@ def gaussian_filter_3d(box, data, sigma_t, sigma_lat, sigma_lon):
     :param sigma_t: sigma time in dimension of time (e.g. year).
     :param sigma_lat: sigma lat in dimension of distance (e.g. km).
     :param sigma_lon: sigma lon in dimension of distance (e.g. km).
+    :param engine: method for smoothing along longitude, see
+        :py:func:`gaussian_filter`.
+    :param workers: number of threads, see :py:func:`gaussian_filter`.
     :return: :py:class:`numpy.ndarray` with the same shape as input.
     """
     res_t, res_lat, res_lon = box.resolution
     s_t = (sigma_t / res_t).m_as('')
     s_lat = (sigma_lat / res_lat).m_as('')
     s_lon = (sigma_lon / res_lon).m_as('')
+    s_rows = row_sigmas(box, s_lon, data.shape[2])
 
     outp = np.zeros_like(data)
-    for i, lat_rad in enumerate(box.lat_bnds.mean(axis=1) / 180 * np.pi):
+
+    def filter_rows(rows):
+        for i in range(rows.start, rows.stop):
+            ndimage.gaussian_filter(
+                data[:, i, :], s_rows[i], mode=['reflect', 'wrap'],
+                output=outp[:, i, :])
+
+    # the per-row filter also acts along time, with the same sigma; in the
+    # fft engine this is one batched FFT for all rows, over the time axis
+    # followed by its mirror image, which makes mode='reflect' periodic
+    def filter_rows_time(lon):
+        block = data[:, :, lon].transpose(2, 1, 0)
+        block = np.concatenate([block, block[..., ::-1]], axis=-1)
+        outp[:, :, lon] = gaussian_filter_periodic(block, s_rows)[
+            ..., :data.shape[0]].transpose(2, 1, 0)
+
+    # the Gaussian is separable: each axis is filtered in turn, splitting
+    # the work along an axis that is not being filtered
+    def filter_time(lon):
+        ndimage.gaussian_filter(
+            outp[:, :, lon], [s_t, 0.0, 0.0], mode='reflect',
+            output=outp[:, :, lon])
+
+    def filter_lat(t):
         ndimage.gaussian_filter(
-            data[:, i, :],
-            min(data.shape[2], s_lon / np.cos(lat_rad)),
-            mode=['reflect', 'wrap'],
-            output=outp[:, i, :])
+            outp[t], [0.0, s_lat, 0.0], mode='reflect', output=outp[t])
+
+    if engine == 'fft':
+        # longitude bands bound the size of the doubled copy of the data
+        bounds = np.linspace(0, data.shape[2], min(
+            data.shape[2], max(workers or 1, FFT_BANDS)) + 1).astype(int)
+        map_tiles(filter_rows_time,
+                  [slice(a, b) for a, b in zip(bounds[:-1], bounds[1:])],
+                  workers)
+        outp[:] = gaussian_filter_periodic(outp, s_rows, workers)
+    else:
+        map_blocks(filter_rows, len(s_rows), workers)
 
-    ndimage.gaussian_filter(
-        outp, [s_t, s_lat, 0.0], mode=['reflect', 'reflect', 'wrap'],
-        output=outp)
+    map_blocks(filter_time, data.shape[2], workers)
+    map_blocks(filter_lat, data.shape[0], workers)
 
     return outp
 
 
-def sobel_filter_2d(box, data, weight=None, physical=True):
+def normalise_gradient(result):
+    """Normalise a gradient in place. The components in ``result[:-1]`` are
+    divided by their vector magnitude, and the last plane, whose contents
+    are ignored, is overwritten with the reciprocal of the magnitude. This
+    is the layout of the output of :py:func:`sobel_filter`.
+
+    :param result: ndarray of shape ``(n + 1, ...)``.
+    """
+    norm = result[-1]
+    temp = np.empty_like(norm)
+    np.square(result[0], out=norm)
+    for component in result[1:-1]:
+        np.square(component, out=temp)
+        norm += temp
+    np.sqrt(norm, out=norm)
+    result[:-1] /= norm
+    np.divide(1, norm, out=norm)
+
+
+def sobel_output(data, output, n_components, order='C'):
+    """Check a caller-supplied output buffer for a Sobel filter, or
+    allocate one in the given memory layout."""
+    shape = (n_components + 1,) + data.shape
+    if output is None:
+        return np.empty(shape, dtype=data.dtype, order=order)
+    if output.shape != shape:
+        raise ValueError(
+            "Output of shape {} does not match expected shape {}."
+            .format(output.shape, shape))
+    return output
+
+
+def sobel_filter_2d(box, data, weight=None, physical=True, output=None):
     """Sobel filter in 2D (lat x lon). Effectively computes a derivative.
     This filter is normalised to return a rate of change per pixel, or
     if weights are given, the value is multiplied by the weight to obtain
@@ -82,27 +277,146 @@ def sobel_filter_2d(box, data, weight=None, physical=True):
         by ``box.resolution``.
     :param physical: wether to correct for geometric projection, by dividing
         the derivative in the longitudinal direction by the cosine of the
-        latitude."""
+        latitude.
+    :param output: optional preallocated array of shape
+        ``(3,) + data.shape`` to write the result to."""
+    dtype = data.dtype
     if weight is None:
         weight = [1/8, 1/8]
     else:
         weight = [(1/8 * w / r).m_as('')
                   for w, r in zip(weight, box.resolution)]
+    weight = [dtype.type(w) for w in weight]
 
-    result = np.array([
-        ndimage.sobel(data, mode=['reflect', 'wrap'], axis=i) * weight[i]
-        for i in range(2)])
+    result = sobel_output(data, output, 2)
+    for i in range(2):
+        ndimage.sobel(data, mode=['reflect', 'wrap'], axis=i, output=result[i])
+        result[i] *= weight[i]
 
     if physical:
-        result[1, :, :] /= np.cos(box.lat / 180 * np.pi)[:, None]
+        result[1, :, :] /= np.cos(box.lat / 180 * np.pi) \
+            .astype(dtype)[:, None]
 
-    result = np.r_[result, np.ones_like(result[0:1])]
-    norm = np.sqrt((result[:-1]**2).sum(axis=0))
-    result /= norm
+    normalise_gradient(result)
     return result
 
 
-def sobel_filter_3d(box, data, weight=None, physical=True, variability=None):
+def sobel_derivatives(data, workers=None, output=None, order='C'):
+    """Unscaled Sobel derivatives of a 3D (time x lat x lon) data set along
+    each of its axes. These are scaled and normalised into the output of
+    :py:func:`sobel_filter` by :py:func:`scale_sobel`, so that several
+    variants can be derived from a single pass of the filter.
+
+    :param data: ndarray or :py:class:`MaskedData`.
+    :param workers: number of threads; the time axis is split in blocks,
+        each read with a halo of one time step.
+    :param output: optional preallocated array of shape
+        ``(4,) + data.shape`` to write the result to.
+    :param order: memory layout of the result if no `output` is given;
+        with ``'F'`` the reversed transpose expected by ``hyper_canny`` is
+        C-contiguous, so it can be passed on without copying. The output
+        of :py:func:`scale_sobel` inherits this layout.
+    :return: array of shape ``(4,) + data.shape``, with the derivatives
+        along time, latitude and longitude in the first three planes; the
+        last plane is left for :py:func:`scale_sobel`. Of type
+        :py:class:`MaskedData` if the input is.
+    """
+    mask = None
+    if isinstance(data, MaskedData):
+        data, mask = data.data, data.mask
+
+    n_t = data.shape[0]
+    if isinstance(output, MaskedData):
+        output = output.data
+    result = sobel_output(data, output, 3, order)
+
+    def filter_block(t):
+        # the Sobel kernel reaches one step in time; the halo is discarded
+        lo, hi = max(0, t.start - 1), min(n_t, t.stop + 1)
+        inner = slice(t.start - lo, t.stop - lo)
+        halo = None
+        if hi - lo > t.stop - t.start:
+            halo = np.empty((hi - lo,) + data.shape[1:], dtype=data.dtype)
+
+        for i in range(3):
+            if halo is None:
+                ndimage.sobel(
+                    data[t], mode=['reflect', 'reflect', 'wrap'], axis=i,
+                    output=result[i, t])
+            else:
+                ndimage.sobel(
+                    data[lo:hi], mode=['reflect', 'reflect', 'wrap'], axis=i,
+                    output=halo)
+                result[i, t] = halo[inner]
+
+    map_blocks(filter_block, n_t, workers)
+    return result if mask is None else MaskedData(result, mask)
+
+
+def scale_sobel(box, derivatives, weight=None, physical=True,
+                variability=None, workers=None, output=None):
+    """Scale the derivatives computed by :py:func:`sobel_derivatives` and
+    normalise them, giving the output of :py:func:`sobel_filter` for the
+    given weights and correction.
+
+    :param box: :py:class:`Box` instance
+    :param derivatives: output of :py:func:`sobel_derivatives`.
+    :param weight: see :py:func:`sobel_filter_3d`.
+    :param physical: see :py:func:`sobel_filter_3d`.
+    :param variability: optional divisor for each component.
+    :param workers: number of threads, over blocks in time.
+    :param output: optional preallocated array of the same shape as
+        `derivatives`; may be `derivatives` itself, to scale in place when
+        the derivatives are not needed any more.
+    :return: array of shape ``(4,) + box.shape``, :py:class:`MaskedData` if
+        the derivatives are.
+    """
+    mask = None
+    if isinstance(derivatives, MaskedData):
+        derivatives, mask = derivatives.data, derivatives.mask
+    if isinstance(output, MaskedData):
+        output = output.data
+
+    dtype = derivatives.dtype
+    if weight is None:
+        weight = [1/16, 1/16, 1/16]
+    else:
+        weight = [(1/16 * w / r).m_as('')
+                  for w, r in zip(weight, box.resolution)]
+    weight = [dtype.type(w) for w in weight]
+
+    if physical:
+        factor = np.cos(box.lat_bnds.mean(axis=1) / 180 * np.pi) \
+            .astype(dtype)[None, :, None]
+
+    if output is None:
+        result = np.empty_like(derivatives)
+    elif output.shape != derivatives.shape:
+        raise ValueError(
+            "Output of shape {} does not match expected shape {}."
+            .format(output.shape, derivatives.shape))
+    else:
+        result = output
+
+    def scale_block(t):
+        block = result[:, t]
+        for i in range(3):
+            np.multiply(derivatives[i, t], weight[i], out=block[i])
+            if variability is not None:
+                block[i] /= dtype.type(variability[i])
+
+        if physical:
+            block[2] /= factor
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            normalise_gradient(block)
+
+    map_blocks(scale_block, derivatives.shape[1], workers)
+    return result if mask is None else MaskedData(result, mask)
+
+
+def sobel_filter_3d(box, data, weight=None, physical=True, variability=None,
+                    workers=None, output=None):
     """Sobel filter in 3D (time x lat x lon). Effectively computes a
     derivative.  This filter is normalised to return a rate of change per
     pixel, or if weights are given, the value is multiplied by the weight to
@@ -116,79 +430,299 @@ def sobel_filter_3d(box, data, weight=None, physical=True, variability=None):
         by ``box.resolution``.
     :param physical: wether to correct for geometric projection, by dividing
         the derivative in the longitudinal direction by the cosine of the
-        latitude."""
-    if weight is None:
-        weight = [1/16, 1/16, 1/16]
-    else:
-        weight = [(1/16 * w / r).m_as('')
-                  for w, r in zip(weight, box.resolution)]
-
-    result = np.array([
-        ndimage.sobel(
-            data, mode=['reflect', 'reflect', 'wrap'], axis=i) * weight[i]
-        for i in range(3)])
-
-    if variability is not None:
-        for i in range(3):
-            result[i] /= variability[i]
-
-    if physical:
-        factor = np.cos(box.lat_bnds.mean(axis=1) / 180 * np.pi)[None, :, None]
-        result[2, :, :, :] /= factor
-
-    result = np.r_[result, np.ones_like(result[0:1])]
-    norm = np.sqrt((result[:-1]**2).sum(axis=0))
-    with np.errstate(divide='ignore', invalid='ignore'):
-        result /= norm
-    return result
+        latitude.
+    :param workers: number of threads; the time axis is split in blocks,
+        each read with a halo of one time step.
+    :param output: optional preallocated array of shape
+        ``(4,) + data.shape`` to write the result to. The three components
+        and the normalisation are computed in place in this buffer."""
+    derivatives = sobel_derivatives(data, workers, output)
+    return scale_sobel(box, derivatives, weight, physical, variability,
+                       workers, output=derivatives)
 
 
 def sobel_filter_3d_masked(
-        box, masked_data, weight=None, physical=True, variability=None):
-    """Compute sobel filter on masked array. The mask is diluted by one pixel
-    afterwards."""
+        box, masked_data, weight=None, physical=True, variability=None,
+        workers=None, output=None):
+    """Compute sobel filter on masked data. The mask of the input is shared
+    by all four components of the output.
+
+    :param masked_data: :py:class:`MaskedData` instance.
+    :return: :py:class:`MaskedData` instance.
+    """
     sb_data = sobel_filter_3d(
-        box, masked_data.data, weight, physical, variability)
+        box, masked_data.data, weight, physical, variability, workers,
+        output)
     # new_mask = ndimage.binary_dilation(
     #     masked_data.mask, ndimage.generate_binary_structure(3, 3),
     #     iterations=1)
-    return np.ma.MaskedArray(
-        sb_data, np.repeat(masked_data.mask[None, :, :, :], 4, axis=0))
+    return MaskedData(sb_data, masked_data.mask)
 
 
-def taper_masked_area(data, size, n_steps):
-    """Iteratively bleed values from valid regions into the masked area using
-    a uniform filter. This should limit boundary effects when filtering later
-    on. The masked area is zeroed before running. Output is written back to the
-    original data."""
-    if not isinstance(data, np.ma.core.MaskedArray):
+def nearest_valid_index(mask, wrap_lon=True):
+    """For each point of a (lat x lon) mask, find the nearest valid point,
+    counting in pixels and taking the periodic longitude into account.
+
+    :param mask: 2D boolean array, True where data is invalid.
+    :param wrap_lon: whether longitude is periodic; if not, the nearest
+        point is only searched within the mask.
+    :return: tuple (i_lat, i_lon) of index arrays with the shape of `mask`.
+    """
+    if not wrap_lon:
+        return ndimage.distance_transform_edt(
+            mask, return_distances=False, return_indices=True)
+
+    n_lon = mask.shape[1]
+    # three copies side by side, so that the nearest point may be found
+    # across the date line
+    i_lat, i_lon = ndimage.distance_transform_edt(
+        np.concatenate([mask] * 3, axis=1),
+        return_distances=False, return_indices=True)
+    return i_lat[:, n_lon:2*n_lon], i_lon[:, n_lon:2*n_lon] % n_lon
+
+
+def global_axes(box):
+    """Whether `box` spans all latitudes, from pole to pole, and all
+    longitudes. A box without bounds is taken to be global.
+
+    :param box: :py:class:`Box` instance.
+    :return: tuple of booleans (lat, lon).
+    """
+    if box.lat_bnds is None or box.lon_bnds is None:
+        return True, True
+    return (bool(np.ptp(box.lat_bnds) >= 180 - 1e-3),
+            bool(np.ptp(box.lon_bnds) >= 360 - 1e-3))
+
+
+@memory.stage('taper')
+def taper_masked_area(data, size, n_steps, workers=None, method='iterative',
+                      wrap=(True, True)):
+    """Bleed values from valid regions into the masked area. This should
+    limit boundary effects when filtering later on. Output is written back
+    to the original data, which should be a :py:class:`MaskedData` or
+    masked array. The methods are:
+
+    ``'iterative'``
+        The masked area is zeroed, then a uniform filter of the given
+        `size` is applied `n_steps` times, each time keeping the valid
+        values.
+    ``'nearest'``
+        Each masked point takes the value of the nearest valid point in the
+        same time step, found by a distance transform of the mask.
+    ``'normalised'``
+        Normalised convolution: a single Gaussian filter over the valid
+        values, divided by the same filter over the valid area. The
+        Gaussian has the variance of `n_steps` passes of the uniform
+        filter. Points out of its reach are filled as with ``'nearest'``.
+
+    The last two need only one pass over the data, and a single distance
+    transform or filter of the mask if it does not change in time.
+
+    :param data: :py:class:`MaskedData` or masked array.
+    :param size: size of the uniform filter, per axis.
+    :param n_steps: number of iterations.
+    :param workers: number of threads; time steps are split over threads
+        if the filter does not extend in time (``size[0] <= 1``).
+    :param method: one of :py:data:`TAPER_METHODS`.
+    :param wrap: whether the filters wrap around in latitude and longitude,
+        see :py:func:`global_axes`; along other axes the edges are
+        reflected, as for a regional window."""
+    if not isinstance(data, (MaskedData, np.ma.core.MaskedArray)):
         raise TypeError("Expected a masked array.")
+    if method not in TAPER_METHODS:
+        raise ValueError("Unknown taper method: {}".format(method))
 
-    if data.mask is np.ma.nomask:
+    if not np.any(data.mask):
         print("Land-sea mask is empty. No smoothing at coasts is needed.", file=sys.stderr)
 
-    data.data[data.mask] = 0.0
-    for _ in range(n_steps):
-        temp = ndimage.uniform_filter(data.data, size, mode='wrap')
-        data.data[data.mask] = temp[data.mask]
+    size = np.broadcast_to(size, (data.ndim,))
+    if method == 'iterative' and size[0] > 1:
+        workers = None
+    elif method == 'normalised' and size[0] > 1:
+        raise ValueError("Normalised tapering is only done within time "
+                         "steps, size[0] should be 0 or 1.")
+
+    mask = data.mask if isinstance(data, MaskedData) \
+        else np.ma.getmaskarray(data)
+    if mask.ndim > 2:
+        mask = compact_mask(mask)
+
+    modes = ['wrap' if w else 'reflect' for w in wrap]
+    if method != 'iterative' and mask.ndim == 2:
+        nearest = nearest_valid_index(mask, wrap[1])
+    if method == 'normalised':
+        sigma = [np.sqrt(n_steps * (s**2 - 1) / 12) if s > 1 else 0.0
+                 for s in size[-2:]]
+        if mask.ndim == 2:
+            weight = ndimage.gaussian_filter(
+                (~mask).astype('float64'), sigma, mode=modes)
+
+    def taper_block(t):
+        values = data.data[t]
+        block_mask = mask if mask.ndim == 2 else mask[t]
+
+        if method == 'iterative':
+            values[..., block_mask] = 0.0
+            for _ in range(n_steps):
+                temp = ndimage.uniform_filter(
+                    values, size, mode=['wrap'] * (values.ndim - 2) + modes)
+                values[..., block_mask] = temp[..., block_mask]
+            return
+
+        for i in range(values.shape[0]):
+            m = block_mask if block_mask.ndim == 2 else block_mask[i]
+            if not m.any() or m.all():
+                continue
+            v = values[i]
+            i_lat, i_lon = nearest if block_mask.ndim == 2 \
+                else nearest_valid_index(m, wrap[1])
+            if method == 'nearest':
+                v[m] = v[i_lat[m], i_lon[m]]
+                continue
+
+            w = weight if block_mask.ndim == 2 else ndimage.gaussian_filter(
+                (~m).astype('float64'), sigma, mode=modes)
+            num = ndimage.gaussian_filter(
+                np.where(m, 0.0, v), sigma, mode=modes, output='float64')
+            reach = m & (w > 0)
+            v[reach] = num[reach] / w[reach]
+            far = m & ~reach
+            v[far] = v[i_lat[far], i_lon[far]]
+
+    map_blocks(taper_block, data.shape[0], workers)
+
+
+def filter_halo(box, sigma_x, truncate=4.0, lat_bnds=None):
+    """Compute the number of grid points in latitude and longitude beyond
+    which data does not influence the result of :py:func:`gaussian_filter`
+    followed by :py:func:`sobel_filter`. The longitudinal width of the
+    Gaussian grows towards the poles, so the halo in longitude is computed
+    for the highest latitude within reach of the region.
+
+    :param box: :py:class:`Box` instance of the grid the filters run on.
+    :param sigma_x: spatial smoothing scale, in dimension of distance.
+    :param truncate: truncation of the Gaussian kernel in units of sigma,
+        should match that used by :py:func:`scipy.ndimage.gaussian_filter`.
+    :param lat_bnds: latitude bounds of the region the result is needed
+        for; defaults to those of `box`.
+    :return: tuple (n_lat, n_lon).
+    """
+    if lat_bnds is None:
+        lat_bnds = box.lat_bnds
+    res_lat, res_lon = box.resolution[-2:]
+    s_lat = (sigma_x / res_lat).m_as('')
+    s_lon = (sigma_x / res_lon).m_as('')
+    n_lat = int(truncate * s_lat + 0.5) + 1
+
+    d_lat = np.abs(np.diff(box.lat)).mean()
+    lat_max = min(90.0, np.abs(lat_bnds).max() + n_lat * d_lat)
+    cos_lat = max(np.cos(lat_max / 180 * np.pi), 1e-6)
+    n_lon = int(truncate * s_lon / cos_lat + 0.5) + 1
+    return n_lat, n_lon
+
+
+def taper_halo(size, n_steps, method='iterative'):
+    """Compute the number of grid points in latitude and longitude beyond
+    which data does not influence the result of :py:func:`taper_masked_area`
+    with the given arguments. Each pass of the uniform filter reaches half
+    its size. The other methods copy values from the nearest valid point,
+    however far, so their reach is not bounded.
+
+    :return: tuple (n_lat, n_lon), or None if the reach is not bounded.
+    """
+    if method != 'iterative':
+        return None
+    size = np.broadcast_to(size, (3,))
+    return tuple(int(n_steps * (s // 2)) for s in size[-2:])
+
+
+def filter_time_halo(box, sigma_t, sigma_x, truncate=4.0):
+    """Compute the number of time steps beyond which data does not influence
+    the result of :py:func:`gaussian_filter` followed by
+    :py:func:`sobel_filter` on a 3D box. Besides the reach of sigma_t, the
+    Gaussian along each latitude row also acts in time, with the sigma of
+    that row, so the halo grows with the widest row. Near the poles that
+    row spans all longitudes, and the halo can reach four times the
+    number of longitudes: hundreds of steps on a 1 degree grid, in which
+    case tiles of fewer steps save little memory.
+
+    :param box: :py:class:`Box` instance.
+    :param sigma_t: temporal smoothing scale, in dimension of time.
+    :param sigma_x: spatial smoothing scale, in dimension of distance.
+    :param truncate: truncation of the Gaussian kernel in units of sigma,
+        should match that used by :py:func:`scipy.ndimage.gaussian_filter`.
+    :return: int
+    """
+    res_t, _, res_lon = box.resolution
+    s_t = (sigma_t / res_t).m_as('')
+    s_lon = (sigma_x / res_lon).m_as('')
+    s_row = max(row_sigmas(box, s_lon, box.shape[2]))
+    return int(truncate * s_t + 0.5) + int(truncate * s_row + 0.5) + 1
+
 
+def scratch_array(shape, dtype, directory=None, order='C'):
+    """Allocate an array backed by an anonymous temporary file, so that its
+    pages can be written back to disk in stead of being held in memory.
+    The file is removed when the array is released.
 
-def gaussian_filter(box, data, sigma):
+    :param shape: shape of the array.
+    :param dtype: data type.
+    :param directory: directory for the file; defaults to the system
+        temporary directory.
+    :param order: memory layout, ``'C'`` or ``'F'``.
+    """
+    with tempfile.TemporaryFile(dir=directory) as f:
+        return np.memmap(f, dtype=dtype, mode='w+', shape=shape,
+                         order=order).view(np.ndarray)
+
+
+@memory.stage('gaussian filter')
+def gaussian_filter(box, data, sigma, engine='ndimage', workers=None):
     """Filters a data set with a Gaussian, correcting for the distortion
     from the geographic projection.
 
+    Along longitude the width of the Gaussian grows towards the poles. With
+    ``engine='ndimage'`` each latitude row is filtered with
+    :py:mod:`scipy.ndimage`, at a cost that grows with the width. With
+    ``engine='fft'`` all rows are filtered at once by multiplying their
+    Fourier transforms along the periodic longitude axis, at the same cost
+    for any width. In 3D the per-row filter also smooths along time with
+    the sigma of the row in pixels, which grows as ``1 / cos(lat)``; the
+    fft engine does this with one batched FFT as well. Both give the same
+    result up to rounding.
+
     :param box: instance of :py:class:`Box`.
-    :param data: data set, dimensions should match ``box.shape``.
+    :param data: data set, dimensions should match ``box.shape``. Of
+        :py:class:`MaskedData` only the data is filtered; the mask is
+        passed on to the output.
     :param sigma: list of sigmas with the correct dimension.
-    :return: :py:class:`numpy.ndarray` with the same shape as input.
+    :param engine: one of :py:data:`SMOOTHING_ENGINES`.
+    :param workers: number of threads. Latitude rows, and for the
+        remaining axes of the Gaussian, longitude bands and time blocks,
+        are filtered in parallel into a shared output.
+    :return: :py:class:`numpy.ndarray` or :py:class:`MaskedData` with the
+        same shape as input.
     """
+    if engine not in SMOOTHING_ENGINES:
+        raise ValueError("Unknown smoothing engine: {}".format(engine))
+
+    mask = None
+    if isinstance(data, MaskedData):
+        data, mask = data.data, data.mask
+
     if isinstance(box.time, np.ndarray):
-        return gaussian_filter_3d(box, data, *sigma)
+        result = gaussian_filter_3d(
+            box, data, *sigma, engine=engine, workers=workers)
     else:
-        return gaussian_filter_2d(box, data, *sigma)
+        result = gaussian_filter_2d(
+            box, data, *sigma, engine=engine, workers=workers)
+
+    return result if mask is None else MaskedData(result, mask)
 
 
-def sobel_filter(box, data, weight=None, physical=True, variability=None):
+@memory.stage('sobel filter')
+def sobel_filter(box, data, weight=None, physical=True, variability=None,
+                 workers=None, output=None):
     """Sobel filter. Effectively computes a derivative.  This filter is
     normalised to return a rate of change per pixel, or if weights are
     given, the value is multiplied by the weight to obtain a unitless
@@ -199,11 +733,88 @@ def sobel_filter(box, data, weight=None, physical=True, variability=None):
         as ``box.shape``.
     :param weight: weight of each dimension in combining components into
         a vector magnitude; should have units corresponding those given
-        by ``box.resolution``."""
+        by ``box.resolution``.
+    :param workers: number of threads for the 3D filter, which is split
+        in blocks along time.
+    :param output: optional preallocated ndarray for the result, of shape
+        ``(data.ndim + 1,) + data.shape``; for masked input this buffer
+        holds the data of the returned :py:class:`MaskedData`."""
     if not isinstance(box.time, np.ndarray):
-        return sobel_filter_2d(box, data, weight, physical)
-    elif isinstance(data, np.ma.core.MaskedArray) and \
-            data.mask is not np.ma.nomask:
-        return sobel_filter_3d_masked(box, data, weight, physical, variability)
+        return sobel_filter_2d(box, data, weight, physical, output)
+    elif isinstance(data, MaskedData):
+        return sobel_filter_3d_masked(
+            box, data, weight, physical, variability, workers, output)
     else:
-        return sobel_filter_3d(box, data, weight, physical, variability)
+        return sobel_filter_3d(
+            box, data, weight, physical, variability, workers, output)
+
+
+@memory.stage('tiled filter')
+def tiled_sobel_filter(box, data, sigma, sobel_args, time_tile,
+                       engine='ndimage', workers=None, taper=None,
+                       directory=None, order='C'):
+    """Apply :py:func:`gaussian_filter` followed by :py:func:`sobel_filter`
+    to a 3D data set in tiles along time, for data sets whose smoothed copy
+    and Sobel output would not fit in memory. Each tile is read with a halo
+    given by :py:func:`filter_time_halo`, that is cut off after filtering,
+    so that the result equals that of filtering the whole data set at
+    once. The Sobel output is written to memory-mapped scratch files, see
+    :py:func:`scratch_array`; peak memory then depends on the size of a
+    tile and its halo, not on the length of the series. A warning is
+    given when the halo is at least as long as a tile.
+
+    :param box: :py:class:`Box` instance of the whole data set.
+    :param data: ndarray or :py:class:`MaskedData`, with same shape as
+        ``box.shape``.
+    :param sigma: list of sigmas, as for :py:func:`gaussian_filter`.
+    :param sobel_args: list of dictionaries with keyword arguments to
+        :py:func:`scale_sobel`; the derivatives of each smoothed tile are
+        computed once, and scaled for each entry.
+    :param time_tile: number of time steps in a tile, not counting halos.
+    :param engine: see :py:func:`gaussian_filter`.
+    :param workers: see :py:func:`gaussian_filter`.
+    :param taper: optional dictionary of keyword arguments to
+        :py:func:`taper_masked_area`; if given, each tile of masked data is
+        tapered before smoothing. The filter size should not extend in
+        time.
+    :param directory: directory for the scratch files.
+    :param order: memory layout of the outputs, see
+        :py:func:`sobel_derivatives`.
+    :return: list of Sobel outputs, one for each entry of `sobel_args`;
+        :py:class:`MaskedData` if the input is.
+    """
+    if time_tile < 1:
+        raise ValueError("Tile size should be positive, got {}."
+                         .format(time_tile))
+    if taper is not None and np.broadcast_to(taper['size'], (3,))[0] > 1:
+        raise ValueError("Tapering across time steps can not be tiled.")
+
+    n_t = data.shape[0]
+    halo = filter_time_halo(box, sigma[0], sigma[2])
+    if halo >= time_tile and time_tile < n_t:
+        warnings.warn(
+            "Tiles of {} time steps are read with a halo of {} steps on "
+            "either side; tiling saves little memory unless the tiles are "
+            "longer than the halo.".format(time_tile, halo))
+    outputs = [scratch_array((4,) + data.shape, data.dtype, directory, order)
+               for _ in sobel_args]
+
+    for start in range(0, n_t, time_tile):
+        stop = min(n_t, start + time_tile)
+        lo, hi = max(0, start - halo), min(n_t, stop + halo)
+        tile = data[lo:hi]
+        if taper is not None and isinstance(tile, MaskedData):
+            tile = tile.copy()
+            taper_masked_area(tile, workers=workers, **taper)
+
+        smooth_tile = gaussian_filter(
+            box, tile, sigma, engine=engine, workers=workers)
+        derivatives = get_data(sobel_derivatives(smooth_tile, workers))
+        for kwargs, output in zip(sobel_args, outputs):
+            scale_sobel(
+                box, derivatives[:, start - lo:stop - lo], workers=workers,
+                output=output[:, start:stop], **kwargs)
+
+    if isinstance(data, MaskedData):
+        return [MaskedData(output, data.mask) for output in outputs]
+    return outputs
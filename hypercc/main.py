@@ -3,14 +3,25 @@ import sys
 import locale
 import noodles
 import argparse
+import multiprocessing
 
-from .workflow import generate_report, run, run_single
+from .workflow import generate_report, update_catalogue, run, run_single
+from .filters import SMOOTHING_ENGINES, TAPER_METHODS
 from .units import MONTHS
+from . import memory, smoothing
+from .smoothing import SmoothingCache
+from .data.cache import ArrayCache, DiskCache
+from .data.data_set import DataSet, SEASONS
 
 
 warnings.simplefilter(action='ignore', category=FutureWarning)
 locale.setlocale(locale.LC_ALL, '')
 
+SWEEP_SMOOTHING_CACHE_SIZE = 2048
+"""Default size in megabytes of the smoothing cache in sweeps. Single
+reports run without it; there only the time series plot smooths a field
+a second time."""
+
 
 def print_nlesc_logo():
     print("\n     \033[47;30m Netherlands\033[48;2;0;174;239;37m▌"
@@ -25,6 +36,17 @@ def print_nlesc_logo():
           "    \033[90m╰───────────────────────────╯\033[m\n", file=sys.stderr)
 
 
+def number_pair(value):
+    """Parse a pair of numbers given as ``A,B``."""
+    try:
+        a, b = map(float, value.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "expected two numbers separated by a comma, got {!r}"
+            .format(value))
+    return a, b
+
+
 def make_argument_parser():
     """Create the argument parser for the `hypercc` script."""
 
@@ -46,10 +68,50 @@ def make_argument_parser():
     parser.add_argument(
         "--single", help="force running in single threaded mode",
         dest="single", action="store_true")
+    parser.add_argument(
+        "--cache-size", help="keep loaded data in memory, up to the given "
+        "number of megabytes (default: %(default)s, disabled)",
+        type=int, default=0, dest='cache_size')
+    parser.add_argument(
+        "--smoothing-cache-size", help="keep smoothed fields in memory, up "
+        "to the given number of megabytes, so that steps smoothing the same "
+        "data share the result (default: {} in sigma and threshold sweeps, "
+        "0 otherwise; 0 disables)".format(SWEEP_SMOOTHING_CACHE_SIZE),
+        type=int, default=None, dest='smoothing_cache_size')
+    parser.add_argument(
+        "--cache-dir", help="store preprocessed data and smoothed fields in "
+        "this folder, to be memory-mapped by later runs on the same input",
+        dest='cache_dir')
+    parser.add_argument(
+        "--load-workers", help="read the metadata of the data files on this "
+        "many processes, which overlaps slow opening of files on mounted "
+        "drives; the processes are started for each data set, which takes "
+        "a while, so this pays off for many files on slow storage only "
+        "(default: %(default)s)",
+        type=int, default=1, dest='load_workers')
+    parser.add_argument(
+        "--precision", help="floating point type used for the data and all "
+        "computations on it (default: %(default)s)",
+        choices=['float32', 'float64'], default='float32', dest='precision')
+    parser.add_argument(
+        "--memory-report", help="trace memory allocations and print the "
+        "peak memory use of each stage; use together with --single",
+        dest='memory_report', action='store_true')
+    parser.add_argument(
+        "--catalogue", help="SQLite index of the archive, as written by the "
+        "catalogue command; used to look up data files in indexed folders",
+        dest='catalogue')
 
     subparser = parser.add_subparsers(
         help="command to run", dest='command')
 
+    catalogue_parser = subparser.add_parser(
+        "catalogue", help="index the CMIP5 files in an archive (default "
+        "index file: hypercc-catalogue.db)")
+    catalogue_parser.set_defaults(func=update_catalogue)
+    catalogue_parser.add_argument(
+        "archive", help="root folder(s) of the archive", nargs='+')
+
     report_parser = subparser.add_parser(
         "report", help="generate complete report")
     report_parser.set_defaults(func=generate_report)
@@ -70,24 +132,76 @@ def make_argument_parser():
     report_parser.add_argument(
         "--extension", help="extension to data files (default: %(default)s)",
         default='nc', dest='extension')
-    report_parser.add_argument(
+    mean_group = report_parser.add_mutually_exclusive_group()
+    mean_group.add_argument(
         "--annual", help="compute annual mean of data instead of selecting "
         " a single month (--month argument is ignored)", dest='annual',
         action='store_true')
+    mean_group.add_argument(
+        "--season", help="compute mean over a meteorological season of "
+        "each year instead of selecting a single month (--month argument is "
+        "ignored)", choices=sorted(SEASONS), dest='season')
     report_parser.add_argument(
         "--month", help="which month to study, give abbreviated month name "
         "as by your locale, or a number in the inclusive range of [1-12].",
         default=MONTHS[0],
         choices=MONTHS + list(map(str, range(1, 13)))
         + list(map('{:02}'.format, range(1, 10))))
+    report_parser.add_argument(
+        "--region", help="only study the window between the given latitudes"
+        " and longitudes, in degrees; the window may cross the date line. It "
+        "is read with a halo as wide as the filters reach, which for tapered "
+        "masked data is wide, or the whole grid with the 'nearest' and "
+        "'normalised' taper methods",
+        nargs=4, type=float, metavar=('LAT0', 'LAT1', 'LON0', 'LON1'),
+        dest='region')
     report_parser.add_argument(
         "--sigma-x", help="spacial smoothing scale, quantity with unit "
         "(default: 200 km)",
         nargs=2, default=['200', 'km'], dest='sigma_x')
+    report_parser.add_argument(
+        "--smoothing-engine", help="method for smoothing along longitude: "
+        "'ndimage' filters each latitude row separately, 'fft' filters all "
+        "rows at once in Fourier space, at the same cost for any width; "
+        "with both, each row is also smoothed along time with its own "
+        "width (default: %(default)s)", choices=SMOOTHING_ENGINES,
+        default='ndimage', dest='smoothing_engine')
+    report_parser.add_argument(
+        "--workers", help="number of threads used by the filters "
+        "(default: number of cores)", type=int,
+        default=multiprocessing.cpu_count(), dest='workers')
+    report_parser.add_argument(
+        "--time-tile", help="smooth and filter the data in tiles of this "
+        "many time steps, writing the Sobel output to temporary files (in "
+        "$TMPDIR), in stead of holding everything in memory at once; each "
+        "tile is read with a halo of time steps, printed in the log, that "
+        "grows with the smoothing width of the widest latitude row, so that "
+        "on fine grids with large --sigma-x tiling is ineffective unless "
+        "the tiles are longer than the halo; a warning is given otherwise",
+        type=int, default=None, dest='time_tile')
+    report_parser.add_argument(
+        "--canny-tiles", help="split edge thinning and hysteresis "
+        "thresholding in this many tiles along longitude, processed on "
+        "--workers threads (default: a single call)",
+        type=int, default=None, dest='canny_tiles')
     report_parser.add_argument(
         "--sigma-t", help="temporal smoothing scale, quantity with unit"
         "(default: 10 year)",
         nargs=2, default=['10', 'year'], dest='sigma_t')
+    report_parser.add_argument(
+        "--sigma-sweep", help="in stead of the report, run calibration and "
+        "edge detection for each pair of temporal and spatial smoothing "
+        "scales, in the units of --sigma-t and --sigma-x; the maps are "
+        "written to sigma_sweep.nc",
+        nargs='+', type=number_pair, metavar='SIGMA_T,SIGMA_X',
+        dest='sigma_sweep')
+    report_parser.add_argument(
+        "--smoothing-pyramid", help="in a sigma sweep, build the smoothed "
+        "fields from the next smaller scale in stead of from the data; this "
+        "is faster, but the results differ from those of separate reports by"
+        " up to a percent of the range of the smoothed field; ignored with "
+        "--time-tile",
+        dest='smoothing_pyramid', action='store_true')
     report_parser.add_argument(
         "--calibration-quartile", help="quartile of sobel response function"
         " to equalize in calibration.",
@@ -110,6 +224,13 @@ def make_argument_parser():
         "--lower-threshold-frac", help="sets value of lower threshold relative to reference"
         "(default: 1)",
         nargs=1, default=['1'], dest='lower_threshold_frac')
+    report_parser.add_argument(
+        "--threshold-sweep", help="in stead of the report, run hysteresis "
+        "thresholding and the statistics for each pair of upper and lower "
+        "threshold fractions, reusing a single pass of the Sobel filter "
+        "and edge thinning; the maps are written to threshold_sweep.nc",
+        nargs='+', type=number_pair, metavar='UPPER,LOWER',
+        dest='threshold_sweep')
     report_parser.add_argument(
         "--sobel-scale", help="scaling of time/space in magnitude of Sobel"
         " operator, should have dimensionality of velocity. (default: "
@@ -117,6 +238,12 @@ def make_argument_parser():
     report_parser.add_argument(
         "--no-taper", help="taper data to handle land/sea mask.",
         dest='taper', action='store_false')
+    report_parser.add_argument(
+        "--taper-method", help="how to fill the masked area: 'iterative' "
+        "applies a uniform filter 50 times, 'nearest' copies the nearest "
+        "valid value, 'normalised' applies a single normalised Gaussian "
+        "(default: %(default)s)", choices=TAPER_METHODS,
+        default='iterative', dest='taper_method')
 
     return parser
 
@@ -135,9 +262,30 @@ if __name__ == "__main__":
 
     parser = make_argument_parser()
     args = parser.parse_args()
-    if args.month not in MONTHS:
+    if args.command == 'report' and args.month not in MONTHS:
         args.month = MONTHS[int(args.month) - 1]
 
+    if args.cache_size > 0:
+        DataSet.cache = ArrayCache(args.cache_size * 2**20)
+    if args.cache_dir:
+        DataSet.disk_cache = DiskCache(args.cache_dir)
+    if args.smoothing_cache_size is None:
+        sweep = getattr(args, 'sigma_sweep', None) \
+            or getattr(args, 'threshold_sweep', None)
+        args.smoothing_cache_size = SWEEP_SMOOTHING_CACHE_SIZE if sweep else 0
+    if args.smoothing_cache_size > 0 or args.cache_dir:
+        smoothing.cache = SmoothingCache(
+            ArrayCache(args.smoothing_cache_size * 2**20)
+            if args.smoothing_cache_size > 0 else None,
+            DataSet.disk_cache)
+    DataSet.dtype = args.precision
+    DataSet.load_workers = args.load_workers
+    if args.memory_report:
+        memory.start()
+
+    if args.command == 'catalogue':
+        args.func(args)
+
     if args.command == 'report':
         workflow = args.func(args)
         if args.single:
@@ -157,6 +305,17 @@ if __name__ == "__main__":
                     print()
             print("max maxTgrad:", results['statistics']['max_maxTgrad'])
             print("max abruptness:", results['statistics']['max_abruptness'])
+            print("regions:", results['statistics']['n_regions'])
+
+            if DataSet.cache is not None:
+                print("data cache:", DataSet.cache.stats)
+            if DataSet.disk_cache is not None:
+                print("disk cache:", DataSet.disk_cache.stats)
+            if smoothing.cache is not None:
+                print("smoothing cache:", smoothing.cache.stats)
+            if args.memory_report:
+                print()
+                print(memory.report())
 
         else:
             print(results)
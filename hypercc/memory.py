@@ -0,0 +1,122 @@
+"""
+Per-stage report of memory use, based on :py:mod:`tracemalloc`.
+
+Stages are marked with :py:func:`stage`, either as a context manager or as a
+decorator. Nothing is recorded unless tracing was started with
+:py:func:`start`. Since tracemalloc keeps a single peak for the whole
+process, the figures are only attributed correctly when stages do not run
+concurrently, i.e. in single threaded runs.
+"""
+
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+import threading
+import tracemalloc
+
+import numpy as np
+
+
+NUMPY_DOMAIN = np.lib.tracemalloc_domain
+"""Tracemalloc domain in which numpy registers the data of its arrays."""
+
+_records = OrderedDict()
+_overall = {'peak': 0}
+_stack = threading.local()
+
+
+def start():
+    """Start tracing memory allocations and clear earlier records."""
+    _records.clear()
+    _overall['peak'] = 0
+    tracemalloc.start()
+
+
+def stop():
+    """Stop tracing memory allocations. Records are kept."""
+    tracemalloc.stop()
+
+
+def _reset_peak():
+    # tracemalloc.reset_peak is new in Python 3.9; without it peaks are
+    # counted from the start of tracing
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+
+
+@contextmanager
+def stage(name):
+    """Record the memory used by a stage of the computation: the peak of
+    traced memory above the level at the start of the stage, the net
+    change, and the number and size of numpy arrays that were allocated
+    in the stage and are still alive at the end of it (usually its
+    output). Nested stages count towards the peak of the enclosing one.
+
+    :param name: name of the stage in the report.
+    """
+    if not tracemalloc.is_tracing():
+        yield
+        return
+
+    stack = _stack.__dict__.setdefault('frames', [])
+    if stack:
+        stack[-1]['peak'] = max(
+            stack[-1]['peak'], tracemalloc.get_traced_memory()[1])
+    arrays_before = _numpy_snapshot()
+    _reset_peak()
+    start_bytes = tracemalloc.get_traced_memory()[0]
+    frame = {'peak': start_bytes}
+    stack.append(frame)
+
+    try:
+        yield
+    finally:
+        current, peak = tracemalloc.get_traced_memory()
+        peak = max(peak, frame['peak'])
+        stack.pop()
+        new_arrays = [size for (_, size), n
+                      in (_numpy_snapshot() - arrays_before).items()
+                      for _ in range(n)]
+
+        record = _records.setdefault(name, {
+            'calls': 0, 'peak': 0, 'net': 0, 'arrays': 0, 'array_bytes': 0})
+        record['calls'] += 1
+        record['peak'] = max(record['peak'], peak - start_bytes)
+        record['net'] += current - start_bytes
+        record['arrays'] += len(new_arrays)
+        record['array_bytes'] += sum(new_arrays)
+
+        _overall['peak'] = max(_overall['peak'], peak)
+        if stack:
+            stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+        _reset_peak()
+
+
+def _numpy_snapshot():
+    """Count the numpy allocations that are currently traced, by traceback
+    and size."""
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.DomainFilter(True, NUMPY_DOMAIN)])
+    return Counter((trace.traceback, trace.size) for trace in snapshot.traces)
+
+
+def records():
+    """Dictionary of recorded stages, in order of first use."""
+    return OrderedDict((k, dict(v)) for k, v in _records.items())
+
+
+def report():
+    """Format the records as a table, sizes in megabytes.
+
+    :return: string.
+    """
+    lines = ["{:<24} {:>6} {:>12} {:>12} {:>8} {:>12}".format(
+        "stage", "calls", "peak (MB)", "net (MB)", "arrays",
+        "array (MB)")]
+    for name, r in _records.items():
+        lines.append("{:<24} {:>6} {:>12.1f} {:>12.1f} {:>8} {:>12.1f}".format(
+            name, r['calls'], r['peak'] / 2**20, r['net'] / 2**20,
+            r['arrays'], r['array_bytes'] / 2**20))
+    if tracemalloc.is_tracing():
+        peak = max(_overall['peak'], tracemalloc.get_traced_memory()[1])
+        lines.append("overall peak: {:.1f} MB".format(peak / 2**20))
+    return "\n".join(lines)
@@ -0,0 +1,68 @@
+"""
+Connected regions of detected edges in space and time.
+
+The edge mask is labelled once; sizes, bounding boxes and centroids of all
+regions are then taken from that single labelling, at a cost linear in the
+volume of the mask, independent of the number of regions.
+"""
+
+import numpy as np
+from scipy import ndimage
+
+
+REGION_CONNECTIVITY = ndimage.generate_binary_structure(3, 3)
+"""Neighbourhood of pixels belonging to the same region: all 26 neighbours
+in time, latitude and longitude."""
+
+
+def find_regions(mask, min_size=0, structure=REGION_CONNECTIVITY):
+    """Label the connected regions of a mask of shape ``(time, lat, lon)``
+    and describe those with more than `min_size` pixels.
+
+    :param mask: boolean mask of edges.
+    :param min_size: regions of this many pixels or fewer are discarded.
+    :param structure: connectivity of the regions.
+    :return: dictionary with
+
+        * ``n_features``: number of regions before discarding small ones;
+        * ``n_regions``: number of regions kept;
+        * ``regions``: array of the shape of `mask` with the label of each
+          kept region, 0 elsewhere;
+        * ``labels``: labels of the kept regions;
+        * ``sizes``: number of pixels in each kept region;
+        * ``bounding_boxes``: tuple of slices (time, lat, lon) around each
+          kept region;
+        * ``durations``: number of time steps spanned by each kept region;
+        * ``centroids``: array of shape ``(n_regions, 3)`` with the mean
+          (time, lat, lon) index of each kept region.
+    """
+    labels, n_features = ndimage.label(mask, structure)
+    sizes = np.bincount(labels.ravel(), minlength=n_features + 1)
+
+    keep = sizes > min_size
+    keep[0] = False
+    regions = np.where(keep[labels], labels, 0)
+    kept = np.flatnonzero(keep)
+
+    objects = ndimage.find_objects(labels)
+    bounding_boxes = [objects[i - 1] for i in kept]
+    durations = np.array([b[0].stop - b[0].start for b in bounding_boxes],
+                         dtype=int)
+
+    # sums of coordinates over the pixels of each label, in a single pass
+    index = np.nonzero(labels)
+    members = labels[index]
+    centroids = np.stack([
+        np.bincount(members, weights=x, minlength=n_features + 1)[kept]
+        for x in index], axis=-1).reshape(-1, 3) / sizes[kept, None]
+
+    return {
+        'n_features': n_features,
+        'n_regions': kept.size,
+        'regions': regions,
+        'labels': kept,
+        'sizes': sizes[kept],
+        'bounding_boxes': bounding_boxes,
+        'durations': durations,
+        'centroids': centroids
+    }
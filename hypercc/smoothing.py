@@ -0,0 +1,162 @@
+"""
+Memoised smoothing of data sets, so that the same field is smoothed only once
+even if several steps of the workflow need it.
+"""
+
+import numpy as np
+
+from .data.cache import data_fingerprint
+from .data.masked import MaskedData
+from .filters import gaussian_filter, taper_masked_area
+
+
+cache = None
+"""Instance of :py:class:`SmoothingCache` used by :py:func:`smooth`, or
+``None`` to disable memoisation."""
+
+
+def smoothing_key(box, data, sigma, taper=None, engine='ndimage'):
+    """Key identifying the result of :py:func:`smooth`. It is computed from
+    the contents of the data and the coordinates of the box, so that
+    identical fields share an entry wherever they come from."""
+    coordinates = [box.time, box.lat, box.lon, box.lat_bnds]
+    return data_fingerprint(
+        [data] + [c for c in coordinates if isinstance(c, np.ndarray)],
+        'smooth', [str(s) for s in sigma], taper, engine)
+
+
+class SmoothingCache(object):
+    """Cache of smoothed fields, in memory and optionally on disk. Results
+    that are kept are read-only.
+
+    :param memory_cache: optional
+        :py:class:`~hypercc.data.cache.ArrayCache`.
+    :param disk_cache: optional :py:class:`~hypercc.data.cache.DiskCache`;
+        entries stored here are memory-mapped by later runs.
+    """
+    def __init__(self, memory_cache=None, disk_cache=None):
+        self.memory_cache = memory_cache
+        self.disk_cache = disk_cache
+
+    def get(self, key):
+        """Look up a smoothed field, first in memory, then on disk.
+
+        :return: the field, or ``None`` if the key is not present.
+        """
+        if self.memory_cache is not None:
+            data = self.memory_cache.get(key)
+            if data is not None:
+                return data
+
+        if self.disk_cache is not None:
+            entry = self.disk_cache.load(key)
+            if entry is not None:
+                return self._remember(key, entry[1])
+
+        return None
+
+    def put(self, key, box, data):
+        """Store a smoothed field.
+
+        :return: the field, read-only if it is kept.
+        """
+        if self.disk_cache is not None:
+            self.disk_cache.store(key, box, data)
+        return self._remember(key, data)
+
+    def _remember(self, key, data):
+        if self.memory_cache is not None:
+            return self.memory_cache.put(key, data)
+        data.setflags(write=False)
+        return data
+
+    @property
+    def stats(self):
+        """Dictionary with the statistics of both caches."""
+        return {
+            'memory': self.memory_cache.stats
+            if self.memory_cache is not None else None,
+            'disk': self.disk_cache.stats
+            if self.disk_cache is not None else None
+        }
+
+
+def smooth(box, data, sigma, taper=None, engine='ndimage', workers=None):
+    """Smooth a data set with :py:func:`~hypercc.filters.gaussian_filter`,
+    after tapering the masked area if the data is masked. If
+    :py:data:`cache` is set, the result is looked up there first, and
+    stored after computing it; it is then read-only, unless it is too large
+    for the memory cache.
+
+    :param box: :py:class:`Box` instance.
+    :param data: ndarray or :py:class:`MaskedData`.
+    :param sigma: list of sigmas, see
+        :py:func:`~hypercc.filters.gaussian_filter`.
+    :param taper: optional dictionary of keyword arguments to
+        :py:func:`~hypercc.filters.taper_masked_area`.
+    :param engine: see :py:func:`~hypercc.filters.gaussian_filter`.
+    :param workers: see :py:func:`~hypercc.filters.gaussian_filter`.
+    """
+    if not isinstance(data, (MaskedData, np.ma.MaskedArray)):
+        taper = None
+
+    if cache is not None:
+        key = smoothing_key(box, data, sigma, taper, engine)
+        result = cache.get(key)
+        if result is not None:
+            return result
+
+    if taper is not None:
+        data = data.copy()
+        taper_masked_area(data, workers=workers, **taper)
+    result = gaussian_filter(box, data, sigma, engine=engine, workers=workers)
+
+    if cache is not None:
+        result = cache.put(key, box, result)
+    return result
+
+
+def incremental_sigma(sigma, base_sigma):
+    """Sigmas of the Gaussian that takes a field smoothed with `base_sigma`
+    to one smoothed with `sigma`. Gaussians compose, so along each axis this
+    is ``sqrt(sigma**2 - base_sigma**2)``.
+
+    :param sigma: list of sigmas, see
+        :py:func:`~hypercc.filters.gaussian_filter`.
+    :param base_sigma: list of sigmas, none larger than in `sigma`.
+    """
+    if any(s < b for s, b in zip(sigma, base_sigma)):
+        raise ValueError(
+            "Can not reach sigmas {} from smaller ones, got {}."
+            .format(sigma, base_sigma))
+    return [(s**2 - b**2)**0.5 for s, b in zip(sigma, base_sigma)]
+
+
+def smooth_pyramid(box, data, sigmas, taper=None, engine='ndimage',
+                   workers=None):
+    """Smooth a data set at a series of growing scales, building each field
+    from the one before with :py:func:`incremental_sigma`. Every step goes
+    through :py:func:`smooth`, so that with :py:data:`cache` set, calls that
+    share the first scales share those fields.
+
+    The result is close to, but not the same as, smoothing from the data
+    directly: the Gaussian along longitude widens towards the poles, so it
+    does not commute with the one along latitude. The difference is of the
+    order of a percent of the range of the field.
+
+    :param box: :py:class:`Box` instance.
+    :param data: ndarray or :py:class:`MaskedData`.
+    :param sigmas: list of lists of sigmas, each at least as large along
+        every axis as the one before.
+    :param taper: see :py:func:`smooth`; the data is tapered once, before
+        the first scale.
+    :param engine: see :py:func:`~hypercc.filters.gaussian_filter`.
+    :param workers: see :py:func:`~hypercc.filters.gaussian_filter`.
+    :return: list of smoothed fields, one for each entry of `sigmas`.
+    """
+    result = [smooth(box, data, sigmas[0], taper, engine, workers)]
+    for base, sigma in zip(sigmas[:-1], sigmas[1:]):
+        result.append(smooth(
+            box, result[-1], incremental_sigma(sigma, base),
+            engine=engine, workers=workers))
+    return result
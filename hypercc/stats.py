@@ -1,5 +1,7 @@
 import numpy as np
 
+from .filters import map_tiles
+
 
 def weighted_quartiles(sample, weights):
     """Compute the minimum, first quartile, median, third
@@ -11,7 +13,164 @@ def weighted_quartiles(sample, weights):
     """
     quartiles = np.array([0, 1/4, 1/2, 3/4, 1])
     order = np.argsort(sample)
-    F = np.cumsum(weights[order])
+    # accumulate in double precision, also for single precision weights
+    F = np.cumsum(weights[order], dtype='float64')
     indices = [min(i, order.size-1)
                for i in np.searchsorted(F, F[-1] * quartiles)]
     return sample[order[indices]]
+
+
+def cumulative(a):
+    """Cumulative sum along the first axis, with a leading zero, so that the
+    sum over ``a[i:j]`` is ``c[j] - c[i]``."""
+    result = np.zeros((a.shape[0] + 1,) + a.shape[1:])
+    np.cumsum(a, axis=0, out=result[1:])
+    return result
+
+
+def measure15j(mask, years, data, cutoff_length, chunk_max_length,
+               chunk_min_length, block_size=2**20, workers=None):
+    """Abruptness of each edge, labeled "measure 15j" during testing: the
+    difference between the intercepts, at the year of the edge, of linear
+    fits to a chunk of data before and after the edge, divided by the mean
+    of the standard deviations of the chunks.
+
+    The chunks leave out `cutoff_length` time steps on either side of the
+    edge and are at most `chunk_max_length` long. If they hold another
+    edge, they are cut off `cutoff_length` steps past it. If either chunk
+    is shorter than `chunk_min_length`, the measure is 0. If both chunks
+    are constant, it is 0 for equal and 9e99 for different values.
+
+    All edges are evaluated at once, from cumulative sums over time in the
+    grid columns that hold edges. The columns are processed in blocks,
+    optionally on a pool of threads.
+
+    :param mask: boolean array (time x lat x lon) of edges.
+    :param years: year of each time step.
+    :param data: array (time x lat x lon).
+    :param cutoff_length: number of time steps left out around edges.
+    :param chunk_max_length: maximum length of a chunk.
+    :param chunk_min_length: minimum length of a chunk.
+    :param block_size: number of elements of a block of columns.
+    :param workers: number of threads; by default the blocks are
+        processed in turn. The blocks release the GIL only within numpy
+        calls, so check the speed-up before using more than one.
+    :return: array of the shape of `mask`.
+    """
+    shape = mask.shape
+    n_t = shape[0]
+    mask = mask.reshape(n_t, -1)
+    data = data.reshape(n_t, -1)
+    result = np.zeros(mask.shape)
+
+    x = np.asarray(years, dtype='float64')
+    x = x - x[0]
+    c_x, c_xx = cumulative(x), cumulative(x * x)
+    steps = np.arange(n_t)[:, None]
+
+    def evaluate(cols):
+        edges = mask[:, cols]
+        values = data[:, cols]
+        y = values.astype('float64')
+        missing = np.isnan(y)
+        y[missing] = 0
+        # the measure does not change with an offset, which would only
+        # cost precision in the sums
+        offset = y[0].copy()
+        y -= offset
+        c_y, c_yy, c_xy = cumulative(y), cumulative(y * y), \
+            cumulative(x[:, None] * y)
+        c_missing = cumulative(missing)
+        c_changes = cumulative(
+            np.r_[np.zeros((1, len(cols))), y[1:] != y[:-1]])
+
+        # last edge at or before, and first edge at or after each step
+        last_edge = np.maximum.accumulate(
+            np.where(edges, steps, -1), axis=0)
+        first_edge = np.minimum.accumulate(
+            np.where(edges, steps, n_t)[::-1], axis=0)[::-1]
+        first_edge = np.r_[first_edge, np.full((1, len(cols)), n_t)]
+
+        t, col = np.nonzero(edges)
+        inside = (t - cutoff_length >= 0) & (t + cutoff_length + 1 <= n_t)
+        t, col = t[inside], col[inside]
+
+        start1 = np.maximum(0, t - cutoff_length - chunk_max_length)
+        end1 = t - cutoff_length
+        previous = np.where(
+            end1 > 0, last_edge[np.maximum(end1 - 1, 0), col], -1)
+        start1 = np.where(
+            previous >= start1, previous + cutoff_length, start1)
+
+        start2 = t + cutoff_length + 1
+        end2 = np.minimum(n_t, start2 + chunk_max_length)
+        following = first_edge[start2, col]
+        end2 = np.where(following < end2, following - cutoff_length, end2)
+
+        long_enough = (end1 - start1 >= chunk_min_length) & \
+            (end2 - start2 >= chunk_min_length)
+        t, col = t[long_enough], col[long_enough]
+        start1, end1 = start1[long_enough], end1[long_enough]
+        start2, end2 = start2[long_enough], end2[long_enough]
+
+        def fit(a, b):
+            n = b - a
+            s_x, s_xx = c_x[b] - c_x[a], c_xx[b] - c_xx[a]
+            s_y = c_y[b, col] - c_y[a, col]
+            s_yy = c_yy[b, col] - c_yy[a, col]
+            s_xy = c_xy[b, col] - c_xy[a, col]
+            mean_x, mean_y = s_x / n, s_y / n
+            slope = (s_xy - s_x * mean_y) / (s_xx - s_x * mean_x)
+            intercept = mean_y + slope * (x[t] - mean_x)
+            constant = c_changes[b, col] - c_changes[a + 1, col] == 0
+            std = np.where(
+                constant, 0, np.sqrt(np.maximum(s_yy / n - mean_y**2, 0)))
+            mean = np.where(constant, values[a, col], mean_y + offset[col])
+            nan = c_missing[b, col] - c_missing[a, col] > 0
+            return intercept, std, mean, nan
+
+        intercept1, std1, mean1, nan1 = fit(start1, end1)
+        intercept2, std2, mean2, nan2 = fit(start2, end2)
+        mean_std = (std1 + std2) / 2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            measure = np.where(
+                mean_std == 0, np.where(mean1 == mean2, 0, 9e99),
+                abs(intercept1 - intercept2) / mean_std)
+        measure[nan1 | nan2] = np.nan
+        result[t, cols[col]] = measure
+
+    # blocks of columns write to disjoint parts of the result
+    columns = np.flatnonzero(mask.any(axis=0))
+    block = max(1, block_size // (n_t + 1))
+    map_tiles(evaluate, [columns[start:start + block]
+                         for start in range(0, len(columns), block)],
+              workers)
+    return result.reshape(shape)
+
+
+def column_argmax(field, years=None, mask=None):
+    """Maximum over time in each column of a 3D field, together with the
+    time step at which it is first reached. Columns whose maximum is not
+    positive, or not a number, count as having none: they get index -1,
+    year 0 and value 0, which is how missing values are shown on maps.
+
+    :param field: array (time x lat x lon).
+    :param years: optional year of each time step.
+    :param mask: optional boolean array of the shape of `field`; values
+        outside it are ignored.
+    :return: dictionary of 2D arrays `index`, `value` and, if `years` is
+        given, `year`.
+    """
+    if mask is not None:
+        field = np.where(mask, field, -np.inf)
+    index = np.argmax(field, axis=0)
+    value = np.take_along_axis(field, index[None], axis=0)[0]
+    found = value > 0
+
+    result = {
+        'index': np.where(found, index, -1),
+        'value': np.where(found, value, 0)
+    }
+    if years is not None:
+        result['year'] = np.where(found, np.asarray(years)[index], 0)
+    return result
@@ -3,18 +3,25 @@ Implements the HyperCanny workflow for climate data.
 """
 
 from pathlib import Path
+import argparse
 
 import matplotlib.pyplot as plt
 import numpy as np
-from scipy import ndimage
 import noodles
 
-from hyper_canny import cp_edge_thinning, cp_double_threshold
-
 from .data.data_set import DataSet
+from .data.catalogue import Catalogue
+from .data.file import NETCDF_LOCK
+from .data.masked import MaskedData, get_data
 from .units import unit, month_index
-from .filters import gaussian_filter, sobel_filter, taper_masked_area
+from .filters import (
+    filter_halo, filter_time_halo, taper_halo, global_axes,
+    sobel_derivatives, scale_sobel, tiled_sobel_filter)
 from .calibration import calibrate_sobel
+from .smoothing import smooth, incremental_sigma
+from .canny import edge_thinning, double_threshold
+from .regions import find_regions
+from . import memory, stats
 from .plotting import plot_signal_histogram, plot_plate_carree
 
 def run(workflow, db_file='hypercc-cache.db'):
@@ -38,20 +45,50 @@ def run_single(workflow, db_file='hypercc-cache.db'):
         db_file=db_file, always_cache=False)
 
 
+def open_catalogue(config):
+    """Open the catalogue given in `config`, if any.
+
+    :param config: namespace object (as returned by argparser)
+    :return: Catalogue or None
+    """
+    if config.catalogue is None:
+        return None
+    return Catalogue(config.catalogue)
+
+
+def update_catalogue(config):
+    """Index the archive folders given in `config` into the catalogue.
+
+    :param config: namespace object (as returned by argparser)
+    """
+    path = config.catalogue or 'hypercc-catalogue.db'
+    with Catalogue(path) as catalogue:
+        for folder in config.archive:
+            n = catalogue.scan(folder)
+            print("{}: {} folder(s) indexed in {}".format(folder, n, path))
+
+
 def open_data_files(config):
     """Open data files from the settings given in `config`.
 
     :param config: namespace object (as returned by argparser)
     :return: DataSet
     """
+    catalogue = open_catalogue(config)
     data_set = DataSet.cmip5(
         path=config.data_folder,
         model=config.model,
         variable=config.variable,
         scenario=config.scenario,
         realization=config.realization,
-        extension=config.extension
+        extension=config.extension,
+        catalogue=catalogue
     )
+    if catalogue is not None:
+        catalogue.close()
+
+    if config.region:
+        data_set = select_region(config, data_set)
 
     return data_set
 
@@ -62,17 +99,64 @@ def open_pi_control(config):
     else:
         pi_control_folder = config.data_folder
 
+    catalogue = open_catalogue(config)
     control_set = DataSet.cmip5(
         path=pi_control_folder,
         model=config.model,
         variable=config.variable,
         scenario='piControl',
         extension=config.extension,
-        realization=config.realization)
+        realization=config.realization,
+        catalogue=catalogue)
+    if catalogue is not None:
+        catalogue.close()
+
+    if config.region:
+        control_set = select_region(config, control_set)
 
     return control_set
 
 
+def select_region(config, data_set):
+    """Restrict the data set to the region given in `config`. The region is
+    extended with a halo wide enough that the filters give the same result
+    inside the region as they would on the global data. For masked data
+    that is tapered, the halo is widened by the reach of the taper; if that
+    reaches a pole, all latitudes are read, as the taper on the global data
+    wraps around from pole to pole.
+
+    :param config: namespace object (as returned by argparser)
+    :param data_set: DataSet
+    :return: DataSet
+    """
+    lat0, lat1, lon0, lon1 = config.region
+    sigma_t, sigma_x = get_sigmas(config)
+    window = data_set.select_region(lat0, lat1, lon0, lon1)
+    # the resolution is taken from the full grid, as a narrow window may
+    # not have enough points to determine it
+    n_lat, n_lon = filter_halo(
+        data_set.box, sigma_x, lat_bnds=window.box.lat_bnds)
+
+    if config.taper and isinstance(data_set[:1].read(), MaskedData):
+        n_lat_total, n_lon_total = data_set.box.shape[1:]
+        reach = taper_halo(**get_taper_args(config))
+        if reach is None:
+            n_lat, n_lon = n_lat_total, n_lon_total
+        else:
+            n_lat, n_lon = n_lat + reach[0], n_lon + reach[1]
+        lat_start, lat_stop = window.window[:2]
+        if lat_start - n_lat <= 0 or lat_stop + n_lat >= n_lat_total:
+            n_lat = n_lat_total
+
+    return window.extend_region(n_lat, n_lon)
+
+
+@noodles.schedule(call_by_ref=['data_set'])
+@noodles.maybe
+def crop_region(data_set):
+    return data_set.crop()
+
+
 @noodles.schedule(call_by_ref=['data_set'])
 @noodles.maybe
 def select_month(config, data_set):
@@ -88,7 +172,17 @@ def annual_mean(data_set):
 
 
 @noodles.schedule(call_by_ref=['data_set'])
-def compute_calibration(config, data_set):
+@noodles.maybe
+def seasonal_mean(config, data_set):
+    print("Computing seasonal mean ({}).".format(config.season.upper()))
+    return data_set.seasonal_mean(config.season)
+
+
+@noodles.schedule(call_by_ref=['data_set', 'smooth_data'])
+def compute_calibration(config, data_set, smooth_data=None):
+    """Calibrate the Sobel filter on the control run in `data_set`. If
+    given, `smooth_data` is the already smoothed field of the data set, see
+    :py:func:`smooth_sweep_level`."""
     quartile = ['min', '1st', 'median', '3rd', 'max'] \
         .index(config.calibration_quartile)
     sigma_t, sigma_x = get_sigmas(config)
@@ -105,14 +199,29 @@ def compute_calibration(config, data_set):
     print("    delta_x: ", sobel_delta_x)
     print("    delta_t: ", sobel_delta_t)
 
-    if config.taper and isinstance(data, np.ma.core.MaskedArray):
+    taper = config.taper and isinstance(data, MaskedData)
+    if taper:
         print("    tapering on")
-        taper_masked_area(data, [0, 5, 5], 50)
 
-    smooth_data = noodles.schedule(gaussian_filter, call_by_ref=['data'])(
-        box, data, [sigma_t, sigma_x, sigma_x])
+    if config.time_tile:
+        print("    tiles of {} time steps, halo of {}".format(
+            config.time_tile, filter_time_halo(box, sigma_t, sigma_x)))
+        sobel_data, = tiled_sobel_filter(
+            box, data, [sigma_t, sigma_x, sigma_x],
+            [dict(weight=[sobel_delta_t, sobel_delta_x, sobel_delta_x])],
+            config.time_tile, engine=config.smoothing_engine,
+            workers=config.workers,
+            taper=get_taper_args(config, box) if taper else None)
+        return calibrate_sobel(
+            quartile, box, data, sobel_delta_t, sobel_delta_x,
+            data_set.interior, sobel_data=sobel_data)
+
+    if smooth_data is None:
+        smooth_data = noodles.schedule(
+            smooth_data_set, call_by_ref=['data'])(config, box, data)
     calibration = noodles.schedule(calibrate_sobel, call_by_ref=['data'])(
-        quartile, box, smooth_data, sobel_delta_t, sobel_delta_x)
+        quartile, box, smooth_data, sobel_delta_t, sobel_delta_x,
+        data_set.interior, workers=config.workers)
 
     return calibration
 
@@ -132,6 +241,44 @@ def get_sigmas(config):
     return sigma_t, sigma_x
 
 
+def get_taper_args(config, box=None):
+    """Keyword arguments to :py:func:`~hypercc.filters.taper_masked_area`;
+    the taper wraps around along the axes that `box` spans completely."""
+    args = dict(size=[0, 5, 5], n_steps=50, method=config.taper_method)
+    if box is not None:
+        args['wrap'] = global_axes(box)
+    return args
+
+
+def smooth_data_set(config, box, data):
+    """Smooth data with the sigmas in `config`, tapering the masked area
+    if configured."""
+    taper = get_taper_args(config, box) if config.taper else None
+    sigma_t, sigma_x = get_sigmas(config)
+    return smooth(
+        box, data, [sigma_t, sigma_x, sigma_x], taper=taper,
+        engine=config.smoothing_engine, workers=config.workers)
+
+
+@noodles.schedule(call_by_ref=['data_set', 'base'])
+@noodles.maybe
+def smooth_sweep_level(config, data_set, base=None, base_config=None):
+    """Smooth `data_set` with the sigmas in `config`; from the data, or if
+    given, from the field `base`, already smoothed with the sigmas in
+    `base_config`. Levels of a sigma sweep are built this way, each one
+    once, from the one kept before it; see :py:func:`sweep_pyramid`."""
+    if base is None:
+        return smooth_data_set(config, data_set.box, data_set.data)
+
+    sigma_t, sigma_x = get_sigmas(config)
+    base_t, base_x = get_sigmas(base_config)
+    return smooth(
+        data_set.box, base,
+        incremental_sigma([sigma_t, sigma_x, sigma_x],
+                          [base_t, base_x, base_x]),
+        engine=config.smoothing_engine, workers=config.workers)
+
+
 def get_sobel_weights(config, calibration):
     sobel_scale = float(config.sobel_scale[0]) * unit(config.sobel_scale[1])
     gamma = get_calibration_factor(config, calibration)
@@ -145,18 +292,28 @@ def get_sobel_weights(config, calibration):
 def generate_signal_plot(
         config, calibration, box, sobel_data, title, filename):
     lower, upper = get_thresholds(config, calibration)
-    fig = plot_signal_histogram(box, 1 / sobel_data[3], lower, upper)
+    signal = 1 / get_data(sobel_data)[3]
+    if isinstance(sobel_data, MaskedData):
+        signal = MaskedData(signal, sobel_data.mask).to_masked_array()
+    fig = plot_signal_histogram(box, signal, lower, upper)
     fig.suptitle(title, fontsize=20)
     fig.savefig(str(filename), bbox_inches='tight')
     return Path(filename)
 
+def canny_layout(sobel_data):
+    """Sobel output in the axis order expected by ``hyper_canny``. This is a
+    view if the output was computed in Fortran order (see
+    :py:func:`sobel_derivatives`); otherwise a transposed copy is made."""
+    return np.ascontiguousarray(get_data(sobel_data).transpose([3, 2, 1, 0]))
+
+
 @noodles.schedule(call_by_ref=['sobel_data'])
 @noodles.maybe
-def maximum_suppression(sobel_data):
-    print("transposing data")
-    trdata = sobel_data.transpose([3, 2, 1, 0]).copy()
+@memory.stage('edge thinning')
+def maximum_suppression(config, sobel_data):
+    trdata = canny_layout(sobel_data)
     print("applying thinning")
-    mask = cp_edge_thinning(trdata)
+    mask = edge_thinning(trdata, config.canny_tiles, config.workers)
     return mask.transpose([2, 1, 0])
 
 
@@ -181,14 +338,16 @@ def get_thresholds(config, calibration):
 
 @noodles.schedule(call_by_ref=['sobel_data', 'mask'])
 @noodles.maybe
+@memory.stage('hysteresis')
 def hysteresis_thresholding(config, sobel_data, mask, calibration):
     lower, upper = get_thresholds(config, calibration)
     print('    thresholds:', lower, upper)
-    new_mask = cp_double_threshold(
-        sobel_data.transpose([3, 2, 1, 0]).copy(),
+    new_mask = double_threshold(
+        canny_layout(sobel_data),
         mask.transpose([2, 1, 0]),
         1. / upper,
-        1. / lower)
+        1. / lower,
+        config.canny_tiles, config.workers)
     return new_mask.transpose([2, 1, 0])
 
 
@@ -212,9 +371,13 @@ def max_signal(sobel_data):
     return 1. / sobel_data[-1].min()
 
 
-@noodles.schedule(call_by_ref=['data_set'])
+@noodles.schedule(call_by_ref=['data_set', 'smooth_data'])
 @noodles.maybe
-def compute_canny_edges(config, data_set, calibration):
+def compute_edge_candidates(config, data_set, calibration, smooth_data=None):
+    """Sobel filter and edge thinning: the part of the edge detection that
+    does not depend on the thresholds, except for the check that the upper
+    threshold is reached at all. If given, `smooth_data` is the already
+    smoothed field of the data set."""
     print("computing canny edges")
     data = data_set.data
     box = data_set.box
@@ -224,12 +387,33 @@ def compute_canny_edges(config, data_set, calibration):
     print("    calibrated weights:",
           ['{:~P}'.format(w) for w in weights])
 
-    if config.taper and isinstance(data, np.ma.core.MaskedArray):
+    taper = config.taper and isinstance(data, MaskedData)
+    if taper:
         print("    tapering")
-        taper_masked_area(data, [0, 5, 5], 50)
 
-    smooth_data = gaussian_filter(box, data, [sigma_t, sigma_x, sigma_x])
-    sobel_data = sobel_filter(box, smooth_data, weight=weights)
+    if config.time_tile:
+        # both Sobel filters are computed in one pass over the tiles
+        print("    tiles of {} time steps, halo of {}".format(
+            config.time_tile, filter_time_halo(box, sigma_t, sigma_x)))
+        sobel_data, pixel_sobel = tiled_sobel_filter(
+            box, data, [sigma_t, sigma_x, sigma_x],
+            [dict(weight=weights), dict(physical=False)],
+            config.time_tile, engine=config.smoothing_engine,
+            workers=config.workers,
+            taper=get_taper_args(config, box) if taper else None,
+            order='F')
+    else:
+        if smooth_data is None:
+            smooth_data = smooth_data_set(config, box, data)
+        # one pass of the Sobel filter, scaled into both variants
+        # in Fortran order, so that edge thinning and hysteresis can read
+        # the output without transposing it
+        derivatives = sobel_derivatives(
+            smooth_data, workers=config.workers, order='F')
+        sobel_data = scale_sobel(
+            box, derivatives, weight=weights, workers=config.workers)
+    if data_set.interior is not None:
+        sobel_data = sobel_data[(slice(None),) + data_set.interior]
 
     max_signal_value = 1 / sobel_data[-1].min()
 
@@ -244,24 +428,50 @@ def compute_canny_edges(config, data_set, calibration):
     if max_signal_value < upper:
         raise ValueError("Maximum signal below upper threshold, no need to continue.");
 
-    pixel_sobel = sobel_filter(box, smooth_data, physical=False)
+    if not config.time_tile:
+        pixel_sobel = scale_sobel(
+            box, derivatives, physical=False, workers=config.workers,
+            output=derivatives)
+    if data_set.interior is not None:
+        pixel_sobel = pixel_sobel[(slice(None),) + data_set.interior]
+        data = data[data_set.interior]
     pixel_sobel = transfer_magnitudes(pixel_sobel, sobel_data)
-    sobel_maxima = maximum_suppression(pixel_sobel)
+    sobel_maxima = maximum_suppression(config, pixel_sobel)
 
-    if isinstance(data, np.ma.core.MaskedArray):
+    if isinstance(data, MaskedData):
         sobel_maxima = apply_mask_to_edges(sobel_maxima, data.mask, 10)
 
-    edges = hysteresis_thresholding(config, sobel_data, sobel_maxima, calibration)
-
     return noodles.gather_dict(
         sobel=sobel_data,
+        maxima=sobel_maxima)
+
+
+@noodles.schedule(call_by_ref=['candidates'])
+@noodles.maybe
+def select_edges(config, candidates, calibration):
+    """Hysteresis thresholding of the output of
+    :py:func:`compute_edge_candidates`, with the thresholds in `config`."""
+    edges = hysteresis_thresholding(
+        config, candidates['sobel'], candidates['maxima'], calibration)
+
+    return noodles.gather_dict(
+        sobel=candidates['sobel'],
         edges=edges)
 
 
+def compute_canny_edges(config, data_set, calibration, smooth_data=None):
+    candidates = compute_edge_candidates(
+        config, data_set, calibration, smooth_data)
+    return select_edges(config, candidates, calibration)
+
+
 @noodles.schedule
 @noodles.maybe
 def compute_maxTgrad(canny):
-    tgrad = canny['sobel'][0]/canny['sobel'][3]       # unit('1/year');
+    sobel = canny['sobel']
+    tgrad = get_data(sobel)[0]/get_data(sobel)[3]     # unit('1/year');
+    if isinstance(sobel, MaskedData):
+        tgrad = MaskedData(tgrad, sobel.mask).to_masked_array()
     tgrad_residual = tgrad - np.mean(tgrad, axis=0)   # remove time mean
     maxm = canny['edges'].max(axis=0)		      # mask
     maxTgrad = np.max(abs(tgrad_residual), axis=0)    # maximum of time gradient
@@ -274,122 +484,39 @@ def compute_maxTgrad(canny):
 ### There are many possible ways to quantify abruptness. This one has been labeled "measure 15j" during the testing:
 @noodles.schedule(call_by_ref=['mask'])
 @noodles.maybe
-def compute_measure15j(mask, years, data, cutoff_length, chunk_max_length, chunk_min_length):
-    from scipy import stats
+@memory.stage('measure 15j')
+def compute_measure15j(mask, years, data, cutoff_length, chunk_max_length,
+                       chunk_min_length):
+    # serial: a speed-up of the threaded blocks has not been measured
+    measure15j_3d = stats.measure15j(
+        mask, years, data, cutoff_length, chunk_max_length, chunk_min_length)
 
-    idx = np.where(mask)
-    indices=np.asarray(idx)
+    # largest abruptness of each grid cell and its year; missing values
+    # are 0, otherwise they show on map
+    maximum = stats.column_argmax(measure15j_3d, years)
 
-    measure15j_3d=mask*0.0
-    
-    shapeidx=np.shape(idx)
-    nofresults=shapeidx[1]
-
-    for result in range(nofresults):
-        [dim0,dim1,dim2]=indices[:,result]
-
-        if mask[dim0, dim1, dim2] == 1:
-            index=dim0
-            if ( index-cutoff_length >= 0 ) and ( index + cutoff_length + 1 <= np.size(data,axis=0) ):
-
-                # determine last index of first chunk, and first index of second chunk
-                # this takes into account how many points aroung the abrupt shift under
-                # consideration are removed, and whether there are other abrupt shifts 
-                #in the vicinity
-
-                # first, remove cutoff length (called ctrans in paper)
-                chunk1_data=data[0:index-cutoff_length,dim1,dim2]
-                chunk2_data=data[index+cutoff_length+1:,dim1,dim2]
-                chunk1_years=years[0:index-cutoff_length]
-                chunk2_years=years[index+cutoff_length+1:]
-                chunk1_mask=mask[0:index-cutoff_length,dim1,dim2]
-                chunk2_mask=mask[index+cutoff_length+1:,dim1,dim2]
-    
-                if np.size(chunk1_data) > chunk_max_length:
-                    chunk1_start=np.size(chunk1_data)-chunk_max_length
-                else:
-                    chunk1_start=0
-                if np.size(chunk2_data) > chunk_max_length:
-                    chunk2_end=chunk_max_length
-                else:
-                    chunk2_end=np.size(chunk2_data)
-    
-                chunk1_data_short=chunk1_data[chunk1_start:]
-                chunk2_data_short=chunk2_data[0:chunk2_end]
-                chunk1_mask_short=chunk1_mask[chunk1_start:]
-                chunk2_mask_short=chunk2_mask[0:chunk2_end]    	    
-                chunk1_years_short=chunk1_years[chunk1_start:]-years[dim0]
-                chunk2_years_short=chunk2_years[0:chunk2_end]-years[dim0]
-
-
-                # check if there are other edges in these chunks, and cut them off
-                if np.sum(chunk1_mask_short) > 0:
-                    #print("There are other edges in chunk 1")
-                    index_edges = np.where(chunk1_mask_short)   # locate all other edges in chunk 1
-                    index_edge=np.max(index_edges)        # take the last one (closest to abrupt shift under consideration here)
-                    if index_edge + cutoff_length >= np.size(chunk1_data_short):   # also consider the cutoff length for that other edge
-                        chunk1_data_short=[]                    
-                    else:
-                        chunk1_data_short=chunk1_data_short[index_edge+cutoff_length:]
-                        chunk1_years_short=chunk1_years_short[index_edge+cutoff_length:]
-
-                if np.sum(chunk2_mask_short) > 0:
-                    #print("There are other edges in chunk 2")
-                    index_edges = np.where(chunk2_mask_short)   # locate all other edges in chunk 1
-                    index_edge=np.min(index_edges)        # take the last one (closest to abrupt shift under consideration here)
-                    if index_edge - cutoff_length < 0 :   # also consider the cutoff length for that other edge
-                        chunk2_data_short=[]                    
-                    else:
-                        chunk2_data_short=chunk2_data_short[0:index_edge-cutoff_length]
-                        chunk2_years_short=chunk2_years_short[0:index_edge-cutoff_length]
-                        
-    	    
-                N1=np.size(chunk1_data_short)
-                N2=np.size(chunk2_data_short)
-    
-                if not ((N1 < chunk_min_length) or (N2 < chunk_min_length)):
-    
-                    slope_chunk1, intercept_chunk1, r_value, p_value, std_err = stats.linregress(chunk1_years_short, chunk1_data_short)
-                    chunk1_regline=intercept_chunk1 + slope_chunk1*chunk1_years_short
-    
-                    slope_chunk2, intercept_chunk2, r_value, p_value, std_err = stats.linregress(chunk2_years_short, chunk2_data_short)
-                    chunk2_regline=intercept_chunk2 + slope_chunk2*chunk2_years_short
-    
-                    mean_std=(np.nanstd(chunk1_data_short)+np.nanstd(chunk2_data_short))/2
-    		
-                    if mean_std == 0:
-                        mean_chunk1=np.mean(chunk1_data_short)
-                        mean_chunk2=np.mean(chunk2_data_short)
-                        if mean_chunk1 == mean_chunk2:
-                            measure15j_3d[dim0,dim1,dim2]=0
-                        else:
-                            measure15j_3d[dim0,dim1,dim2]=9e99
-                    else:
-                        measure15j_3d[dim0,dim1,dim2]=abs(intercept_chunk1-intercept_chunk2)/mean_std
-        
-    measure15j=np.max(measure15j_3d,axis=0)
-    measure15j[np.isnan(measure15j)]=0
-    indices_mask=np.where(measure15j>np.max(measure15j))  # set missing values to 0
-    measure15j[indices_mask]=0                            # otherwise they show on map
-    
     return {
-        'measure15j_3d': measure15j_3d,
-	'measure15j':    measure15j
+        'measure15j_3d':   measure15j_3d,
+        'measure15j':      maximum['value'],
+        'index_maxabrupt': maximum['index'],
+        'years_maxabrupt': maximum['year']
     }
 
 @noodles.schedule
 @noodles.maybe
 def write_netcdf_2d(field, filename):
     import netCDF4
-    ncfile = netCDF4.Dataset(filename, "a", format="NETCDF4")
-    ncfile.variables['outdata'][0,:,:]=field
-    ncfile.close()
+    with NETCDF_LOCK:
+        ncfile = netCDF4.Dataset(filename, "a", format="NETCDF4")
+        ncfile.variables['outdata'][0,:,:]=field
+        ncfile.close()
 
 def write_netcdf_3d(field, filename):
     import netCDF4
-    ncfile = netCDF4.Dataset(filename, "a", format="NETCDF4")
-    ncfile.variables['outdata'][:,:,:]=field
-    ncfile.close()
+    with NETCDF_LOCK:
+        ncfile = netCDF4.Dataset(filename, "a", format="NETCDF4")
+        ncfile.variables['outdata'][:,:,:]=field
+        ncfile.close()
 
 
 @noodles.schedule
@@ -413,26 +540,33 @@ def generate_standard_map_plot(box, field, title, filename):
     fig.savefig(str(filename), bbox_inches='tight')
     return Path(filename)
 
-@noodles.schedule(call_by_ref=['abruptness','abruptness_3d'])
+@noodles.schedule(call_by_ref=['data_set', 'abruptness', 'index_maxabrupt'])
 @noodles.maybe
-def generate_timeseries_plot(config, box, data, abruptness, abruptness_3d, title, filename):
+def generate_timeseries_plot(config, data_set, abruptness, index_maxabrupt,
+                             title, filename):
+    """Plot the data and the smoothed data at the grid cell with the largest
+    abruptness. For a region, `data_set` should still hold the halo, so that
+    the smoothing matches that of the edge detection; it is cropped after
+    smoothing."""
     import matplotlib
     sigma_t, sigma_x = get_sigmas(config)
     if np.max(abs(abruptness)) > 0:
-        lonind=np.nanargmax(np.nanmax(abruptness, axis=0))
-        latind=np.nanargmax(np.nanmax(abruptness, axis=1))
-        ts=data[:,latind,lonind]
-        years = np.array([dd.year for dd in box.dates])
+        box, data = data_set.box, data_set.data
+        if data_set.interior is not None:
+            box, data = box[data_set.interior], data[data_set.interior]
+        latind, lonind = np.unravel_index(
+            np.argmax(abruptness), abruptness.shape)
+        ts=get_data(data)[:,latind,lonind]
+        years = box.years
         fig = plt.figure()
         ax=plt.subplot(111)
 
         ### smoothed data
-        sigma_t, sigma_x = get_sigmas(config)
-        if config.taper and isinstance(data, np.ma.core.MaskedArray):
-            taper_masked_area(data, [0, 5, 5], 50)
-        smooth_data = gaussian_filter(box, data, [sigma_t, sigma_x, sigma_x])
- 	
-        ts_smooth=smooth_data[:,latind,lonind]
+        smooth_data = smooth_data_set(config, data_set.box, data_set.data)
+        if data_set.interior is not None:
+            smooth_data = smooth_data[data_set.interior]
+
+        ts_smooth=get_data(smooth_data)[:,latind,lonind]
     
         ax.plot(years, ts, 'k', years, ts_smooth, 'b--')
 
@@ -449,7 +583,7 @@ def generate_timeseries_plot(config, box, data, abruptness, abruptness_3d, title
         ax.text(xpos,ypos,'abruptness: '+ '{:f}'.format(abruptness_max),color='r',size=16)
 
         ## show year of the most abrupt event as vertical red line
-        index=np.where(abruptness_3d[:,latind,lonind]==abruptness_max)
+        index=index_maxabrupt[latind,lonind]
         ax.axvline(x=years[index], ymin=0, ymax=1, color='r', linestyle="--")
 
         fig.suptitle(title, fontsize=20)
@@ -461,30 +595,18 @@ def generate_timeseries_plot(config, box, data, abruptness, abruptness_3d, title
 @noodles.schedule(call_by_ref=['mask'])
 @noodles.maybe
 def label_regions(mask, min_size=0):
-    labels, n_features = ndimage.label(
-        mask, ndimage.generate_binary_structure(3, 3))
-    big_enough = [x for x in range(1, n_features+1)
-                  if (labels == x).sum() > min_size]
-    return noodles.gather_dict(
-        n_features=n_features,
-        regions=np.where(np.isin(labels, big_enough), labels, 0),
-        labels=big_enough)
+    return find_regions(mask, min_size)
 
 
-@noodles.schedule(call_by_ref=['mask'])
+@noodles.schedule(call_by_ref=['regions'])
 @noodles.maybe
-def generate_region_plot(box, mask, title, filename, min_size=0):
+def generate_region_plot(box, regions, title, filename):
     import matplotlib
     my_cmap = matplotlib.cm.get_cmap('rainbow')
     my_cmap.set_under('w')
-    labels, n_features = ndimage.label(
-        mask, ndimage.generate_binary_structure(3, 3))
-    print('    n_features:', n_features)
-    if n_features > 0:
-        big_enough = [x for x in range(1, n_features+1)
-        	          if (labels == x).sum() > min_size]
-        regions = np.where(np.isin(labels, big_enough), labels, 0)
-        regions_show=regions.max(axis=0)
+    print('    n_features:', regions['n_features'])
+    if regions['n_regions'] > 0:
+        regions_show = regions['regions'].max(axis=0)
         fig = plot_plate_carree(box, regions_show, cmap=my_cmap, vmin=1)
         fig.suptitle(title)
         fig.savefig(str(filename), bbox_inches='tight')
@@ -500,7 +622,7 @@ def generate_scatter_plot(mask,sb,colourdata,sizedata,colourbarlabel,gamma,lower
         idx    = np.where(mask)
         sizdata  = sizedata[idx[0], idx[1], idx[2]]
         coldata  = colourdata[idx[0], idx[1], idx[2]]
-        sobel  = sb[:, idx[0], idx[1], idx[2]]
+        sobel  = get_data(sb)[:, idx[0], idx[1], idx[2]]
         sgrad = np.sqrt(sobel[1]**2 + sobel[2]**2) / gamma
         sgrad = sgrad/sobel[3]*1000    # scale to 1000 km
         tgrad = sobel[0]/sobel[3]*10      # scale to 10 years
@@ -555,23 +677,6 @@ def generate_scatter_plot(mask,sb,colourdata,sizedata,colourbarlabel,gamma,lower
 
 
 
-@noodles.schedule(call_by_ref=['mask'])
-@noodles.maybe
-def compute_years_maxabrupt(box, mask, abruptness_3d, abruptness):
-    idx=np.where(mask)
-    indices=np.asarray(idx)
-    mask_max=mask*0
-    shapeidx=np.shape(idx)
-    nofresults=shapeidx[1]
-    for result in range(nofresults):
-        [dim0,dim1,dim2]=indices[:,result]
-        if (abruptness_3d[dim0, dim1, dim2] == abruptness[dim1,dim2]) and abruptness[dim1,dim2] > 0:
-            mask_max[dim0, dim1, dim2] = 1
-    years = np.array([dd.year for dd in box.dates])
-    years_maxabrupt=(years[:,None,None]*mask_max).sum(axis=0)
-    return years_maxabrupt
-
-
 @noodles.schedule
 @noodles.maybe
 def generate_year_plot(box, years_maxabrupt, title, filename):
@@ -598,13 +703,16 @@ def generate_event_count_timeseries_plot(box, mask, title, filename):
     fig.savefig(str(filename), bbox_inches='tight')
     return Path(filename)
 
-@noodles.schedule(call_by_ref=['data_set', 'canny_edges'])
+@noodles.schedule(call_by_ref=['data_set', 'canny_edges', 'halo_set'])
 @noodles.maybe
-def make_report(config, data_set, calibration, canny_edges):
+def make_report(config, data_set, calibration, canny_edges, halo_set=None):
+    """Plots, maps and statistics of the edges detected in the (cropped)
+    `data_set`. For a region, `halo_set` is the data set before cropping,
+    from which the time series plot is smoothed."""
     output_path  = Path(config.output_folder)
     
     gamma = get_calibration_factor(config, calibration)
-    years = np.array([dd.year for dd in data_set.box.dates])
+    years = data_set.box.years
     #years_timeseries_out = write_ts(years, output_path / "years_timeseries.txt")
 
     mask=canny_edges['edges']
@@ -620,19 +728,21 @@ def make_report(config, data_set, calibration, canny_edges):
     maxTgrad      = compute_maxTgrad(canny_edges)
     
     ## abruptness
-    measures      = compute_measure15j(mask, years, data_set.data, 2, 30, 15)
+    measures      = compute_measure15j(
+        mask, years, get_data(data_set.data), 2, 30, 15)
     abruptness_3d = measures['measure15j_3d']
     abruptness    = measures['measure15j']
 
-    years_maxabrupt = compute_years_maxabrupt(data_set.box, mask, abruptness_3d, abruptness)
+    years_maxabrupt = measures['years_maxabrupt']
     
     event_count_timeseries = mask.sum(axis=1).sum(axis=1)  
 
     signal_plot  = generate_signal_plot(
         config, calibration, data_set.box, canny_edges['sobel'], "signal",
         output_path / "signal.png")
+    edge_regions = label_regions(mask)
     region_plot  = generate_region_plot(
-        data_set.box, canny_edges['edges'], "regions",
+        data_set.box, edge_regions, "regions",
         output_path / "regions.png")
     event_count_timeseries_plot = generate_event_count_timeseries_plot(
         data_set.box, canny_edges['edges'], "event count",
@@ -648,7 +758,9 @@ def make_report(config, data_set, calibration, canny_edges):
         data_set.box, maxTgrad,
         "max. time gradient", output_path / "maxTgrad.png")
     timeseries_plot = generate_timeseries_plot(
-        config, data_set.box, data_set.data, abruptness, abruptness_3d, "data at grid cell with largest abruptness",
+        config, data_set if halo_set is None else halo_set, abruptness,
+        measures['index_maxabrupt'],
+        "data at grid cell with largest abruptness",
         output_path / "timeseries.png")
 
     year_plot    = generate_year_plot(
@@ -682,7 +794,8 @@ def make_report(config, data_set, calibration, canny_edges):
         'statistics': {
             'max_maxTgrad': maxTgrad.max(),
 
-            'max_abruptness': abruptness.max()
+            'max_abruptness': abruptness.max(),
+            'n_regions': edge_regions['n_regions']
         },
         'signal_plot': signal_plot,
         'region_plot': region_plot,
@@ -708,6 +821,186 @@ def make_report(config, data_set, calibration, canny_edges):
     })
 
 
+def threshold_sweep_configs(config):
+    """Copies of `config`, one for each pair of upper and lower threshold
+    fractions in ``config.threshold_sweep``."""
+    return [
+        argparse.Namespace(**dict(
+            vars(config), threshold_sweep=None,
+            upper_threshold_frac=[str(upper)],
+            lower_threshold_frac=[str(lower)]))
+        for upper, lower in config.threshold_sweep]
+
+
+@noodles.schedule(call_by_ref=['data_set', 'canny_edges'])
+@noodles.maybe
+def sweep_statistics(config, data_set, calibration, canny_edges):
+    """Maps of the statistics of :py:func:`make_report` for one entry of a
+    threshold or sigma sweep."""
+    mask = canny_edges['edges']
+    lower_threshold, upper_threshold = get_thresholds(config, calibration)
+    measures = compute_measure15j(
+        mask, data_set.box.years, get_data(data_set.data), 2, 30, 15)
+
+    return noodles.gather_dict(
+        upper_threshold=upper_threshold,
+        lower_threshold=lower_threshold,
+        n_regions=label_regions(mask)['n_regions'],
+        event_count=mask.sum(axis=0),
+        maxTgrad=compute_maxTgrad(canny_edges),
+        abruptness=measures['measure15j'],
+        years_maxabrupt=measures['years_maxabrupt'])
+
+
+SWEEP_MAPS = ['event_count', 'maxTgrad', 'abruptness', 'years_maxabrupt']
+
+
+@noodles.schedule(call_by_ref=['data_set', 'statistics'])
+@noodles.maybe
+def write_sweep(configs, calibration, data_set, statistics, dimension,
+                filename):
+    """Write the maps of a sweep to a single NetCDF file, in which
+    `dimension` runs over `configs`. The sigmas and thresholds of each
+    entry are stored along. Entries for which the edge detection failed
+    are masked."""
+    import netCDF4
+    box = data_set.box
+    failed = [noodles.failed(s) for s in statistics]
+    for c, s in zip(configs, statistics):
+        if noodles.failed(s):
+            print("sigmas {}, {}, thresholds {}, {} failed: {}".format(
+                c.sigma_t, c.sigma_x, c.upper_threshold_frac,
+                c.lower_threshold_frac, s))
+
+    with NETCDF_LOCK:
+        ncfile = netCDF4.Dataset(str(filename), "w", format="NETCDF4")
+        ncfile.createDimension(dimension, len(configs))
+        ncfile.createDimension('lat', len(box.lat))
+        ncfile.createDimension('lon', len(box.lon))
+        ncfile.createVariable('lat', 'f8', ('lat',))[:] = box.lat
+        ncfile.createVariable('lon', 'f8', ('lon',))[:] = box.lon
+        for name in ['sigma_t', 'sigma_x',
+                     'upper_threshold_frac', 'lower_threshold_frac']:
+            var = ncfile.createVariable(name, 'f8', (dimension,))
+            var[:] = [float(getattr(c, name)[0]) for c in configs]
+            if name.startswith('sigma'):
+                var.units = getattr(configs[0], name)[1]
+        for name in ['upper_threshold', 'lower_threshold']:
+            ncfile.createVariable(name, 'f8', (dimension,))[:] = \
+                np.ma.masked_array(
+                    [np.nan if f else s[name]
+                     for s, f in zip(statistics, failed)], failed)
+        ncfile.createVariable('n_regions', 'i4', (dimension,))[:] = \
+            np.ma.masked_array(
+                [0 if f else s['n_regions']
+                 for s, f in zip(statistics, failed)], failed)
+        for name in SWEEP_MAPS:
+            ncfile.createVariable(
+                name, 'f8', (dimension, 'lat', 'lon'))[:] = np.ma.stack(
+                    [np.ma.masked_all(box.shape[1:]) if f else s[name]
+                     for s, f in zip(statistics, failed)])
+        ncfile.close()
+
+    return {
+        'calibration': calibration,
+        'statistics': {
+            'max_maxTgrad': [None if f else s['maxTgrad'].max()
+                             for s, f in zip(statistics, failed)],
+            'max_abruptness': [None if f else s['abruptness'].max()
+                               for s, f in zip(statistics, failed)],
+            'n_regions': [None if f else s['n_regions']
+                          for s, f in zip(statistics, failed)]
+        },
+        'sweep_out': Path(filename)
+    }
+
+
+def make_threshold_sweep(config, data_set, calibration):
+    """Run the edge detection for each pair of thresholds in
+    ``config.threshold_sweep``. The Sobel filter and edge thinning are
+    computed once; hysteresis thresholding and the statistics of the report
+    are repeated for each pair, and written to ``threshold_sweep.nc``."""
+    configs = threshold_sweep_configs(config)
+    # the check on the maximum signal uses the lowest upper threshold
+    lowest = min(configs, key=lambda c: float(c.upper_threshold_frac[0]))
+    candidates = compute_edge_candidates(lowest, data_set, calibration)
+    cropped = crop_region(data_set)
+    statistics = noodles.gather(*[
+        sweep_statistics(
+            c, cropped, calibration, select_edges(c, candidates, calibration))
+        for c in configs])
+    return write_sweep(
+        configs, calibration, cropped, statistics, 'threshold',
+        Path(config.output_folder) / "threshold_sweep.nc")
+
+
+def sigma_sweep_configs(config):
+    """Copies of `config`, one for each pair of sigmas in
+    ``config.sigma_sweep``, from small to large. The pairs are in the units
+    of ``config.sigma_t`` and ``config.sigma_x``."""
+    return [
+        argparse.Namespace(**dict(
+            vars(config), sigma_sweep=None,
+            sigma_t=[str(sigma_t), config.sigma_t[1]],
+            sigma_x=[str(sigma_x), config.sigma_x[1]]))
+        for sigma_t, sigma_x in sorted(set(config.sigma_sweep))]
+
+
+def sweep_pyramid(configs, data_set):
+    """Smoothed fields of `data_set` for each of the `configs` of
+    :py:func:`sigma_sweep_configs`. Each field is built from that of the
+    latest earlier config that is no larger along either axis, or from the
+    data if there is none, see :py:func:`~hypercc.smoothing.smooth_pyramid`.
+    Every level is smoothed once and kept until the levels built from it
+    are done, whether or not :py:data:`hypercc.smoothing.cache` is set.
+
+    :return: list of promised fields, one for each config.
+    """
+    sigmas = [get_sigmas(c) for c in configs]
+    levels = []
+    for i, (config, (sigma_t, sigma_x)) in enumerate(zip(configs, sigmas)):
+        smaller = [j for j in range(i)
+                   if sigmas[j][0] <= sigma_t and sigmas[j][1] <= sigma_x]
+        if smaller:
+            levels.append(smooth_sweep_level(
+                config, data_set, levels[smaller[-1]], configs[smaller[-1]]))
+        else:
+            levels.append(smooth_sweep_level(config, data_set))
+    return levels
+
+
+def make_sigma_sweep(config, data_set, control_set):
+    """Run calibration and edge detection for each pair of sigmas in
+    ``config.sigma_sweep``, and write the statistics of the report to
+    ``sigma_sweep.nc``. With ``config.smoothing_pyramid`` set, and no time
+    tiles, the smoothed fields of both the data and the control run are
+    built incrementally from the smaller scales, see
+    :py:func:`sweep_pyramid`; otherwise each scale is smoothed from the
+    data, and the results equal those of separate reports."""
+    configs = sigma_sweep_configs(config)
+    if config.smoothing_pyramid and not config.time_tile:
+        data_levels = sweep_pyramid(configs, data_set)
+        control_levels = sweep_pyramid(configs, control_set)
+    else:
+        data_levels = control_levels = [None] * len(configs)
+
+    cropped = crop_region(data_set)
+    calibrations, statistics = [], []
+    for c, data_level, control_level in zip(
+            configs, data_levels, control_levels):
+        calibration = compute_calibration(c, control_set, control_level)
+        canny_edges = compute_canny_edges(
+            c, data_set, calibration, data_level)
+        calibrations.append(calibration)
+        statistics.append(
+            sweep_statistics(c, cropped, calibration, canny_edges))
+
+    return write_sweep(
+        configs, noodles.gather(*calibrations), cropped,
+        noodles.gather(*statistics), 'scale',
+        Path(config.output_folder) / "sigma_sweep.nc")
+
+
 def generate_report(config):
     output_path = Path(config.output_folder)
     output_path.mkdir(parents=True, exist_ok=True)
@@ -716,9 +1009,20 @@ def generate_report(config):
     if config.annual:
         data_set = annual_mean(data_set)
         control_set = annual_mean(control_set)
+    elif config.season:
+        data_set = seasonal_mean(config, data_set)
+        control_set = seasonal_mean(config, control_set)
     else:
         data_set = select_month(config, data_set)
         control_set = select_month(config, control_set)
+    if config.sigma_sweep and config.threshold_sweep:
+        raise ValueError("A sigma sweep can not be combined with a "
+                         "threshold sweep.")
+    if config.sigma_sweep:
+        return make_sigma_sweep(config, data_set, control_set)
     calibration = compute_calibration(config, control_set)
+    if config.threshold_sweep:
+        return make_threshold_sweep(config, data_set, calibration)
     canny_edges = compute_canny_edges(config, data_set, calibration)
-    return make_report(config, data_set, calibration, canny_edges)
+    return make_report(
+        config, crop_region(data_set), calibration, canny_edges, data_set)
@@ -0,0 +1,54 @@
+"""
+Tests of edge thinning and hysteresis thresholding in tiles, in
+:py:mod:`hypercc.canny`, against single calls to ``hyper_canny``.
+"""
+
+import numpy as np
+import pytest
+from scipy import ndimage
+
+pytest.importorskip('hyper_canny')
+
+from hypercc.canny import (                                  # noqa: E402
+    EDGE_CONNECTIVITY, tile_bounds, edge_thinning, double_threshold)
+
+
+def random_sobel(shape=(24, 10, 30), seed=0):
+    """Sobel output in the layout of ``hyper_canny``, with a smooth
+    magnitude, so that edges form components spanning several pixels."""
+    random = np.random.RandomState(seed)
+    sobel = random.normal(size=shape + (4,))
+    magnitude = ndimage.gaussian_filter(random.normal(size=shape), 1.5)
+    magnitude -= magnitude.min() - 0.01
+    sobel[..., 3] = 1 / magnitude
+    return np.ascontiguousarray(sobel), magnitude
+
+
+@pytest.mark.parametrize('n_tiles', [2, 3, 7])
+def test_edge_thinning_tiles(n_tiles):
+    sobel, _ = random_sobel()
+    expected = edge_thinning(sobel)
+    result = edge_thinning(sobel, n_tiles=n_tiles, workers=2)
+    assert np.array_equal(result, np.asarray(expected, dtype=bool))
+
+
+@pytest.mark.parametrize('n_tiles', [2, 3, 7])
+@pytest.mark.parametrize('seed', [0, 1])
+def test_double_threshold_tiles(n_tiles, seed):
+    sobel, magnitude = random_sobel(seed=seed)
+    # thinned edges, as in the workflow, are connected diagonally
+    mask = np.ascontiguousarray(edge_thinning(sobel), dtype=bool)
+    upper, lower = [1 / np.percentile(magnitude, q) for q in (97, 70)]
+
+    # some components above the lower threshold cross tile boundaries
+    labels, _ = ndimage.label(
+        mask & (magnitude >= 1 / lower), EDGE_CONNECTIVITY)
+    tiles = tile_bounds(magnitude.shape[0], n_tiles)
+    assert any(np.intersect1d(labels[t.start - 1], labels[t.start]).any()
+               for t in tiles[1:])
+
+    expected = double_threshold(sobel, mask, upper, lower)
+    result = double_threshold(
+        sobel, mask, upper, lower, n_tiles=n_tiles, workers=2)
+    assert np.asarray(expected, dtype=bool).any()
+    assert np.array_equal(result, np.asarray(expected, dtype=bool))
@@ -0,0 +1,20 @@
+"""
+Tests of the SQLite index of CMIP5 files in :py:mod:`hypercc.data.catalogue`.
+"""
+
+from hypercc.data.catalogue import Catalogue
+
+
+def test_scan_keeps_directories_outside_root(tmp_path):
+    # '_' is a wildcard in SQL like patterns
+    for name in ['a_b', 'aXb']:
+        (tmp_path / name / 'tas').mkdir(parents=True)
+
+    with Catalogue(tmp_path / 'catalogue.db') as catalogue:
+        catalogue.scan(tmp_path / 'aXb')
+        catalogue.scan(tmp_path / 'a_b')
+        paths = {path for (path,) in catalogue.db.execute(
+            "select path from directories")}
+
+    assert str((tmp_path / 'aXb' / 'tas').resolve()) in paths
+    assert str((tmp_path / 'a_b' / 'tas').resolve()) in paths
@@ -0,0 +1,104 @@
+"""
+Tests of the Gaussian smoothing engines and the tiled Sobel filter in
+:py:mod:`hypercc.filters`.
+"""
+
+import numpy as np
+import pytest
+
+from hypercc.data.box import Box
+from hypercc.filters import (
+    gaussian_filter, gaussian_filter_2d, gaussian_filter_3d, filter_time_halo,
+    sobel_derivatives, scale_sobel, tiled_sobel_filter)
+from hypercc.units import unit
+
+
+SIGMAS_X = [100, 500, 2000, 5000]
+"""Spatial smoothing scales in km; on the grid below, the widest ones
+give kernels wider than a latitude row near the poles."""
+
+TOLERANCE = {'float32': 1e-5, 'float64': 1e-10}
+"""Largest difference between the engines, relative to the largest value
+of the result."""
+
+
+def periodic_box(n_lat, n_lon, n_time=None):
+    """Global box with `n_lat` latitudes and `n_lon` longitudes, and if
+    given, `n_time` yearly time steps."""
+    lat = np.linspace(-90.0, 90.0, n_lat + 2)[1:-1]
+    lon = np.linspace(0.0, 360.0, n_lon, endpoint=False)
+    time = None if n_time is None else np.arange(n_time) * 365.0
+    box = Box(time, lat, lon)
+    box.generate_bounds()
+    return box
+
+
+def assert_agree(fft_result, ndimage_result, dtype):
+    atol = TOLERANCE[dtype] * np.abs(ndimage_result).max()
+    np.testing.assert_allclose(fft_result, ndimage_result, rtol=0, atol=atol)
+
+
+@pytest.mark.parametrize('dtype', ['float32', 'float64'])
+@pytest.mark.parametrize('sigma_x', SIGMAS_X)
+def test_fft_engine_2d(sigma_x, dtype):
+    box = periodic_box(12, 24)
+    data = np.random.RandomState(0).normal(size=box.shape).astype(dtype)
+    sigma = sigma_x * unit.km
+
+    results = [gaussian_filter_2d(box, data, sigma, sigma, engine=engine)
+               for engine in ['fft', 'ndimage']]
+    assert results[0].dtype == data.dtype
+    assert_agree(*results, dtype)
+
+
+@pytest.mark.parametrize('dtype', ['float32', 'float64'])
+@pytest.mark.parametrize('sigma_x', SIGMAS_X)
+def test_fft_engine_3d(sigma_x, dtype):
+    box = periodic_box(12, 24, 20)
+    data = np.random.RandomState(0).normal(size=box.shape).astype(dtype)
+    sigma = sigma_x * unit.km
+
+    results = [gaussian_filter_3d(box, data, 3 * unit.year, sigma, sigma,
+                                  engine=engine)
+               for engine in ['fft', 'ndimage']]
+    assert results[0].dtype == data.dtype
+    assert_agree(*results, dtype)
+
+
+def untiled_sobel(box, data, sigma, sobel_args, engine):
+    smooth_data = gaussian_filter(box, data, sigma, engine=engine)
+    derivatives = sobel_derivatives(smooth_data)
+    return [scale_sobel(box, derivatives, **kwargs) for kwargs in sobel_args]
+
+
+@pytest.mark.parametrize('dtype', ['float32', 'float64'])
+@pytest.mark.parametrize('engine', ['ndimage', 'fft'])
+def test_tiled_sobel_filter(engine, dtype):
+    box = periodic_box(8, 16, 120)
+    data = np.random.RandomState(0).normal(size=box.shape).astype(dtype)
+    sigma = [1 * unit.year, 500 * unit.km, 500 * unit.km]
+    sobel_args = [dict(weight=[1 * unit.year, 1000 * unit.km,
+                               1000 * unit.km]),
+                  dict(physical=False)]
+    time_tile = 25
+    # the tiles, with their halos, are shorter than the series
+    assert time_tile + 2 * filter_time_halo(box, *sigma[::2]) < box.shape[0]
+
+    results = tiled_sobel_filter(
+        box, data, sigma, sobel_args, time_tile, engine=engine)
+    expected = untiled_sobel(box, data, sigma, sobel_args, engine)
+    for result, reference in zip(results, expected):
+        if engine == 'ndimage':
+            # the same kernels are applied to the same values
+            np.testing.assert_array_equal(result, reference)
+        else:
+            # FFTs of different lengths round differently
+            assert_agree(result, reference, dtype)
+
+
+def test_tiled_sobel_filter_warns_on_long_halo():
+    box = periodic_box(8, 16, 120)
+    data = np.random.RandomState(0).normal(size=box.shape)
+    sigma = [3 * unit.year, 500 * unit.km, 500 * unit.km]
+    with pytest.warns(UserWarning, match='halo'):
+        tiled_sobel_filter(box, data, sigma, [{}], 5)
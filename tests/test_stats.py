@@ -0,0 +1,138 @@
+"""
+Tests of the abruptness measure and the column maxima in
+:py:mod:`hypercc.stats`, against straightforward per-edge loops.
+"""
+
+import numpy as np
+import pytest
+from scipy import stats as scipy_stats
+
+from hypercc.stats import measure15j, column_argmax
+
+
+def reference_measure15j(mask, years, data, cutoff_length, chunk_max_length,
+                         chunk_min_length):
+    """Measure 15j of each edge, one edge at a time, with
+    :py:func:`scipy.stats.linregress` fits to the chunks around it."""
+    n_t = mask.shape[0]
+    result = np.zeros(mask.shape)
+    for t, i, j in zip(*np.nonzero(mask)):
+        if t - cutoff_length < 0 or t + cutoff_length + 1 > n_t:
+            continue
+
+        # chunks around the edge, cut off past any other edge in them
+        start1 = max(0, t - cutoff_length - chunk_max_length)
+        end1 = t - cutoff_length
+        others = np.flatnonzero(mask[start1:end1, i, j])
+        if others.size:
+            start1 = min(end1, start1 + others[-1] + cutoff_length)
+        start2 = t + cutoff_length + 1
+        end2 = min(n_t, start2 + chunk_max_length)
+        others = np.flatnonzero(mask[start2:end2, i, j])
+        if others.size:
+            end2 = max(start2, start2 + others[0] - cutoff_length)
+        if end1 - start1 < chunk_min_length or \
+                end2 - start2 < chunk_min_length:
+            continue
+
+        x1, y1 = years[start1:end1] - years[t], data[start1:end1, i, j]
+        x2, y2 = years[start2:end2] - years[t], data[start2:end2, i, j]
+        if np.isnan(y1).any() or np.isnan(y2).any():
+            # linregress gives a NaN intercept
+            result[t, i, j] = np.nan
+            continue
+
+        intercept1 = scipy_stats.linregress(x1, y1).intercept
+        intercept2 = scipy_stats.linregress(x2, y2).intercept
+        mean_std = (np.std(y1) + np.std(y2)) / 2
+        if mean_std == 0:
+            result[t, i, j] = 0 if np.mean(y1) == np.mean(y2) else 9e99
+        else:
+            result[t, i, j] = abs(intercept1 - intercept2) / mean_std
+    return result
+
+
+def reference_column_max(field, years):
+    """Maximum of each column, 0 if not positive or not a number, and the
+    sum of the years of the time steps at which it is reached, with the
+    number of those steps."""
+    value = np.max(field, axis=0)
+    value[~(value > 0)] = 0
+    reached = (field == value) & (value > 0)
+    return value, (years[:, None, None] * reached).sum(axis=0), \
+        reached.sum(axis=0)
+
+
+def random_case(seed, n_t=80, shape=(6, 7)):
+    """Random walks with steps, sparse and clustered edges, constant
+    columns with and without a step, and masked (NaN) columns."""
+    random = np.random.RandomState(seed)
+    data = np.cumsum(random.normal(size=(n_t,) + shape), axis=0)
+    data[n_t // 2:] += 5 * random.normal(size=shape)
+    mask = random.uniform(size=data.shape) < 0.03
+    mask[n_t // 2 - 1:n_t // 2 + 2] |= random.uniform(size=shape) < 0.3
+
+    data[:, 0, 0] = 1.0
+    data[:, 0, 1] = np.where(np.arange(n_t) < n_t // 2, 1.0, 2.0)
+    mask[n_t // 2, 0, :2] = True
+    data[:, 1, 0] = np.nan
+    data[n_t // 3, 1, 1] = np.nan
+    mask[n_t // 2, 1, :2] = True
+    return mask, np.arange(1850, 1850 + n_t), data
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+@pytest.mark.parametrize('cutoff_length,chunk_max_length,chunk_min_length',
+                         [(2, 30, 15), (0, 30, 15), (1, 10, 3), (5, 20, 8)])
+def test_measure15j(seed, cutoff_length, chunk_max_length, chunk_min_length):
+    mask, years, data = random_case(seed)
+    args = (cutoff_length, chunk_max_length, chunk_min_length)
+    result = measure15j(mask, years, data, *args, block_size=200)
+    expected = reference_measure15j(mask, years, data, *args)
+
+    assert np.array_equal(np.isnan(result), np.isnan(expected))
+    assert np.array_equal(result == 9e99, expected == 9e99)
+    np.testing.assert_allclose(
+        np.nan_to_num(result), np.nan_to_num(expected), rtol=1e-9, atol=1e-9)
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_column_argmax(seed):
+    mask, years, data = random_case(seed)
+    field = measure15j(mask, years, data, 2, 30, 15)
+    maximum = column_argmax(field, years)
+    value, year, n_reached = reference_column_max(field, years)
+
+    assert np.array_equal(maximum['value'], value)
+    unique = n_reached <= 1
+    assert np.array_equal(maximum['year'][unique], year[unique])
+    # of tied maxima, the first is taken
+    tied = np.argmax(field == value, axis=0)
+    assert np.array_equal(maximum['year'][~unique], years[tied][~unique])
+    found = maximum['index'] >= 0
+    assert np.array_equal(found, value > 0)
+    assert np.array_equal(
+        np.take_along_axis(field, maximum['index'][None], axis=0)[0][found],
+        value[found])
+
+
+def test_column_argmax_ties_and_mask():
+    field = np.zeros((4, 1, 3))
+    field[[1, 3], 0, 0] = 2.0
+    field[:, 0, 1] = [np.nan, 1.0, 3.0, -1.0]
+    field[:, 0, 2] = -1.0
+    years = np.array([2000, 2001, 2002, 2003])
+
+    maximum = column_argmax(field, years)
+    # the first of tied maxima; no maximum in columns with NaN or
+    # without a positive value
+    assert maximum['index'].tolist() == [[1, -1, -1]]
+    assert maximum['year'].tolist() == [[2001, 0, 0]]
+    assert maximum['value'].tolist() == [[2.0, 0.0, 0.0]]
+
+    mask = np.ones(field.shape, dtype=bool)
+    mask[1, 0, 0] = False
+    mask[0, 0, 1] = False
+    maximum = column_argmax(field, years, mask)
+    assert maximum['index'].tolist() == [[3, 2, -1]]
+    assert maximum['year'].tolist() == [[2003, 2002, 0]]